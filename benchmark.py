@@ -0,0 +1,343 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# benchmark of the osm2graph pipeline on synthetic networks
+#
+# generates grid or tree shaped road networks with bus and tram route
+# relations, runs every stage of osm2graph on them and records the time and
+# the memory of each stage (growth of the rss, the rss after it and the peak
+# of the pool workers) with the profiler of osm2graph. The results are saved
+# as JSON so runs of different commits can be compared with --compare.
+import argparse
+import collections
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import multiprocessing
+
+import numpy as np
+
+import osm2graph
+
+# nodes per osm way (the streets are cut into several ways like real data)
+WAY_NODES = 12
+# a stop every STOP_SPACING nodes of a route
+STOP_SPACING = 6
+STREETS = ['residential', 'tertiary', 'secondary', 'footway', 'service', 'cycleway']
+
+def nodeXML(out, nid, lat, lon, tags=None):
+    if tags:
+        out.write('<node id="%d" lat="%.7f" lon="%.7f">' % (nid, lat, lon))
+        for k, v in tags:
+            out.write('<tag k="%s" v="%s"/>' % (k, v))
+        out.write('</node>\n')
+    else:
+        out.write('<node id="%d" lat="%.7f" lon="%.7f"/>\n' % (nid, lat, lon))
+
+def wayXML(out, wid, nds, tags):
+    out.write('<way id="%d">' % wid)
+    for nid in nds:
+        out.write('<nd ref="%d"/>' % nid)
+    for k, v in tags:
+        out.write('<tag k="%s" v="%s"/>' % (k, v))
+    out.write('</way>\n')
+
+def routeXML(out, rid, route, stops, ways, platforms=()):
+    out.write('<relation id="%d">' % rid)
+    for nid in stops:
+        out.write('<member type="node" ref="%d" role="stop"/>' % nid)
+        if nid in platforms:
+            out.write('<member type="node" ref="%d" role="platform"/>' % platforms[nid])
+    for wid in ways:
+        out.write('<member type="way" ref="%d" role=""/>' % wid)
+    out.write('<tag k="type" v="route"/><tag k="route" v="%s"/>' % route)
+    out.write('<tag k="name" v="%s %d"/></relation>\n' % (route, rid))
+
+def stopAreaXML(out, rid, stop, platform):
+    out.write('<relation id="%d">' % rid)
+    out.write('<member type="node" ref="%d" role="stop"/>' % stop)
+    out.write('<member type="node" ref="%d" role="platform"/>' % platform)
+    out.write('<tag k="type" v="public_transport"/><tag k="public_transport" v="stop_area"/>')
+    out.write('</relation>\n')
+
+def stopTags(route):
+    if route == 'tram':
+        return [('railway', 'tram_stop')]
+    return [('public_transport', 'stop_position')]
+
+def streetTags(rnd):
+    tags = [('highway', rnd.choice(STREETS))]
+    if rnd.random() < 0.1:
+        tags.append(('oneway', 'yes'))
+    return tags
+
+# writes a square grid of about nodes nodes: every row and column is a street
+# made of several ways, every 8th row has a bus and every 8th column a tram
+# each stop has a platform beside the street, both form a stop area
+def generateGrid(filename, nodes, seed=1):
+    rnd = random.Random(seed)
+    side = max(2, int(round(nodes ** 0.5)))
+    nid = lambda r, c: r * side + c + 1
+    lines = set(i for i in range(side) if i % 8 == 4)
+
+    out = open(filename, 'w')
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+    platforms = {} # stop node: platform node
+    for r in range(side):
+        for c in range(side):
+            tags = None
+            if r in lines and c % STOP_SPACING == 0:
+                tags = stopTags('bus')
+            elif c in lines and r % STOP_SPACING == 0:
+                tags = stopTags('tram')
+            lat = 52 + r * 0.0009 + rnd.uniform(-1e-4, 1e-4)
+            lon = 10 + c * 0.0015 + rnd.uniform(-1e-4, 1e-4)
+            nodeXML(out, nid(r, c), lat, lon, tags)
+            if tags:
+                platforms[nid(r, c)] = pid = side * side + len(platforms) + 1
+                nodeXML(out, pid, lat + 0.0001, lon + 0.0001, [('public_transport', 'platform')])
+
+    wid = 1
+    routes = []
+    for vertical in (False, True):
+        for i in range(side):
+            ways = []
+            for first in range(0, side - 1, WAY_NODES):
+                cells = range(first, min(side, first + WAY_NODES + 1))
+                nds = [nid(j, i) if vertical else nid(i, j) for j in cells]
+                tags = streetTags(rnd)
+                if i in lines:# routes only on streets usable in both directions
+                    tags = [('highway', 'tertiary')]
+                wayXML(out, wid, nds, tags)
+                ways.append(wid)
+                wid += 1
+            if i in lines:
+                stops = [nid(j, i) if vertical else nid(i, j) for j in range(0, side, STOP_SPACING)]
+                routes.append(('tram' if vertical else 'bus', stops, ways))
+    for rid, (route, stops, ways) in enumerate(routes):
+        routeXML(out, rid + 1, route, stops, ways, platforms)
+    for stop in sorted(platforms):
+        stopAreaXML(out, len(routes) + stop, stop, platforms[stop])
+    out.write('</osm>\n')
+    out.close()
+
+# writes a tree of about nodes nodes: a trunk with branches which have
+# branches again. Branches are random walks, the trunk and the first level
+# branches have a bus or tram route.
+def generateTree(filename, nodes, seed=1):
+    rnd = random.Random(seed)
+    # branch: (parent node, first node id, node count, depth) - the nodes of
+    # a branch are numbered continuously
+    branches = []
+    nextid = 2
+    pending = collections.deque([(1, 0)])
+    while pending and nextid <= nodes:
+        parent, depth = pending.popleft()
+        count = min(max(4, int(nodes ** 0.5) // (depth + 1)), nodes - nextid + 1)
+        branches.append((parent, nextid, count, depth))
+        for nid in range(nextid, nextid + count, max(2, count // 4)):
+            pending.append((nid, depth + 1))
+        nextid += count
+
+    wid = 1
+    ways = []
+    routes = []
+    stops = {}
+    for b, (parent, first, count, depth) in enumerate(branches):
+        nds = [parent] + range(first, first + count)
+        parts = []
+        for i in range(0, len(nds) - 1, WAY_NODES):
+            parts.append((wid, nds[i:i + WAY_NODES + 1]))
+            wid += 1
+        ways.append(parts)
+        if depth <= 1:
+            route = 'tram' if b % 3 == 2 else 'bus'
+            for nid in nds[::STOP_SPACING]:
+                stops.setdefault(nid, route)
+            routes.append((route, nds[::STOP_SPACING], [w for w, n in parts]))
+
+    out = open(filename, 'w')
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+    # every branch walks away from its parent
+    lat = np.zeros(nextid)
+    lon = np.zeros(nextid)
+    lat[1], lon[1] = 52.0, 10.0
+    nodeXML(out, 1, lat[1], lon[1], 1 in stops and stopTags(stops[1]))
+    for parent, first, count, depth in branches:
+        y, x = lat[parent], lon[parent]
+        h = rnd.uniform(0, 2 * math.pi)
+        for nid in range(first, first + count):
+            h += rnd.uniform(-0.3, 0.3)
+            y += 0.0008 * math.sin(h)
+            x += 0.0012 * math.cos(h)
+            lat[nid], lon[nid] = y, x
+            nodeXML(out, nid, y, x, nid in stops and stopTags(stops[nid]))
+    for b, parts in enumerate(ways):
+        for w, nds in parts:
+            tags = [('highway', 'secondary')]
+            if branches[b][3] > 1:
+                tags = streetTags(rnd)
+            wayXML(out, w, nds, tags)
+    for rid, (route, s, members) in enumerate(routes):
+        routeXML(out, rid + 1, route, s, members)
+    out.write('</osm>\n')
+    out.close()
+
+GENERATORS = {'grid': generateGrid, 'tree': generateTree}
+
+def benchmarkRun(filename, transport, tmpdir):
+    """ runs the pipeline on one generated network and returns the stages
+        recorded by the profiler of osm2graph """
+    profiler = osm2graph.profiler
+    profiler.reset()
+    baseline = profiler.rss()
+    osm = osm2graph.OSM(filename, transport)
+    with profiler.stage('csr'):
+        osm.toCSR()
+    with profiler.stage('export_hw'):
+        osm.export(os.path.join(tmpdir, "hw.osm"), "hw")
+    with profiler.stage('export_pt'):
+        osm.export(os.path.join(tmpdir, "pt.osm"), "pt")
+    with profiler.stage('export_matlab'):
+        osm.convert2mat(os.path.join(tmpdir, "export.m"))
+
+    return {'nodes': len(osm.nodes), 'edges': len(osm.ways),
+            'relations': len(osm.relations), 'transport': transport,
+            'baseline_mb': round(baseline, 1), 'stages': profiler.report()['stages']}
+
+# runs function(*args) in a process of its own and returns its result - so
+# the memory of one run does not stay in the next one
+def isolated(function, *args):
+    queue = multiprocessing.Queue()
+    def target():
+        try:
+            queue.put((function(*args), None))
+        except Exception:
+            queue.put((None, traceback.format_exc()))
+    p = multiprocessing.Process(target=target)
+    p.start()
+    result, error = queue.get()
+    p.join()
+    return result, error
+
+def benchmark(shapes, sizes, transport):
+    """ generates every shape and size and runs the pipeline on it """
+    results = []
+    for shape in shapes:
+        for nodes in sizes:
+            tmpdir = tempfile.mkdtemp(prefix="osm2graph-bench")
+            try:
+                filename = os.path.join(tmpdir, "%s-%d.osm" % (shape, nodes))
+                start = time.time()
+                result, error = isolated(GENERATORS[shape], filename, nodes)
+                generate = time.time() - start
+                if error is None:
+                    result, error = isolated(benchmarkRun, filename, transport, tmpdir)
+                if error is None:
+                    result.update({'shape': shape, 'generate_seconds': round(generate, 2),
+                        'file_mb': round(os.path.getsize(filename) / 1048576., 1)})
+                else:
+                    result = {'shape': shape, 'nodes': nodes, 'error': error}
+            finally:
+                shutil.rmtree(tmpdir)
+            results.append(result)
+            report(result)
+    return results
+
+def report(result):
+    if 'error' in result:
+        print "%s %d nodes failed:\n%s" % (result['shape'], result['nodes'], result['error'])
+        return
+    print "%s %d nodes, %d edges, %d relations (%.1f MB osm)" % (result['shape'],
+            result['nodes'], result['edges'], result['relations'], result['file_mb'])
+    for stage in result['stages']:
+        print "  %-18s %9.3f s %+9.1f MB %9.1f MB rss %9.1f MB workers" % (stage['stage'],
+                stage['seconds'], stage['delta_mb'], stage['rss_mb'], stage['workers_mb'])
+
+def revision():
+    """ returns the git commit of osm2graph or None """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(osm2graph.__file__)),
+                stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+MIN_SECONDS = 0.5
+MIN_MB = 10.
+
+def stageMemory(stage):
+    """ the memory a stage needs in MB: its rss growth or the peak of its
+        pool workers - None for runs before these were recorded """
+    if 'delta_mb' not in stage:
+        return None
+    return max(stage['delta_mb'], stage['workers_mb'])
+
+# prints the time and memory ratios (new/old) of the runs both files have
+def compare(oldfile, newfile, threshold):
+    old = json.load(open(oldfile))
+    new = json.load(open(newfile))
+    runs = dict(((r['shape'], r['nodes']), r) for r in old['runs'])
+    regressions = 0
+    for run in new['runs']:
+        before = runs.get((run['shape'], run['nodes']))
+        if before is None or 'error' in run or 'error' in before:
+            continue
+        print "%s %d nodes: %s -> %s" % (run['shape'], run['nodes'],
+                old.get('revision'), new.get('revision'))
+        stages = dict((s['stage'], s) for s in before['stages'])
+        for stage in run['stages']:
+            if stage['stage'] not in stages:
+                continue
+            a = stages[stage['stage']]
+            # short stages are too noisy to compare
+            time_ratio = max(stage['seconds'], MIN_SECONDS) / max(a['seconds'], MIN_SECONDS)
+            mem_ratio = 1.
+            if stageMemory(stage) is not None and stageMemory(a) is not None:
+                mem_ratio = max(stageMemory(stage), MIN_MB) / max(stageMemory(a), MIN_MB)
+            flag = ""
+            if time_ratio > threshold or mem_ratio > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print "  %-18s time x%.2f  memory x%.2f%s" % (stage['stage'], time_ratio, mem_ratio, flag)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Benchmarks osm2graph on generated grid and tree networks')
+    parser.add_argument("-s", "--sizes", default="10000,100000",
+            help="comma separated node counts (default: %(default)s)")
+    parser.add_argument("--shapes", default="grid,tree",
+            help="comma separated network shapes: grid, tree (default: %(default)s)")
+    parser.add_argument("-t", "--transport", choices=["all", "hw", "pt"], default="all")
+    parser.add_argument("-o", "--output", help="write the results as json to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+            help="compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=1.2,
+            help="ratio from which --compare reports a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    osm2graph.verbose = 0
+    shapes = args.shapes.split(",")
+    sizes = [int(s) for s in args.sizes.split(",")]
+    result = {'revision': revision(), 'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'python': platform.python_version(), 'machine': platform.machine(),
+            'runs': benchmark(shapes, sizes, args.transport)}
+    if args.output:
+        out = open(args.output, "w")
+        json.dump(result, out, indent=1, sort_keys=True)
+        out.close()
+
+if __name__ == "__main__":
+    main()
@@ -27,7 +27,8 @@ provide a export function to a neo4j database
 """
 
 import xml.sax
-from xml.sax.saxutils import XMLGenerator
+import xml.parsers.expat
+from xml.sax.saxutils import XMLGenerator, quoteattr
 import copy
 import networkx
 
@@ -39,21 +40,143 @@ import matplotlib.pyplot as plt
 
 import math
 import urllib
+import numpy as np
+
+import itertools
+import multiprocessing
+import struct
+import zlib
+import gzip
+import os
+import hashlib
+import cPickle as pickle
+import shutil
+import tempfile
+import heapq
+import time
+import json
+import csv
+import sqlite3
+import zipfile
+import resource
+import contextlib
+import gc
+from multiprocessing.pool import ThreadPool
 
 verbose = 1
 errors = 0
 
-def vprint(stri,level):
+# highway classes of the exported edges
+# 1:footway, 2:cycleway, 3:big_street, 4:small_street, 5:bus, 6:tram
+HIGHWAY_CLASSES = {'footway':1, 'cycleway':2, 'path':1, 'residental':4,'motorway':3,'trunk':3,'motorway_link':3,'primary':3,
+        'secondary':3, 'tertiary':4, 'living_street':4, 'unclassified':4, 'service':4, 'track':2, 'steps':1,
+        'bus':5, 'tram':6}
+
+# tags which have to be the same to merge two ways of a chain
+CHAIN_TAGS = ('highway', 'railway', 'oneway', 'junction', 'foot', 'bicycle', 'access')
+
+# walking transfers between stops/platforms and onto the streets: the
+# longest one in km and the tags of the transfer edges
+TRANSFER_DISTANCE = 0.1
+TRANSFER_TAGS = {'highway':'footway', 'footway':'transfer'}
+KM_PER_DEGREE = 6371 * math.pi / 180
+CELL_KEY = 1 << 22 # combines the two grid cell coordinates to one number
+
+# colour and line width of each highway class in rendered images, drawn in
+# this order (bus and tram lines on top)
+RENDER_STYLE = [(1, '#b4b4b4', 0.4), (2, '#5aa05a', 0.5), (4, '#787878', 0.7),
+        (3, '#e89a2c', 1.4), (5, '#1f6fd1', 1.0), (6, '#c2185b', 1.0)]
+
+# prints stri if the verbosity is at least level - with args stri is a
+# format string which is only filled in if it is printed
+def vprint(stri,level,*args):
     global verbose
     if verbose >= level:
+        if args:
+            stri = stri % args
         print stri
 
-def getNetwork(left,bottom,right,top,transport="all"):
-    """ Returns a filename to the downloaded data.
-        down loads highways and public transport
-    """
+# Profiler
+#
+# collects the wall time and the memory of the stages of a run: the growth of
+# the current rss during the stage, the rss after it and the peak rss of the
+# largest pool worker that ended in it. Stages with the same name (e.g. called
+# in a loop) are summed up.
+class Profiler:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stages = []
+        self.index = {}
+        self.start = time.time()
+
+    def peak(self):
+        """ max rss of this process in MB (linux reports kilobytes) """
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    def rss(self):
+        """ current rss of this process in MB - the peak where there is no
+            /proc """
+        try:
+            fp = open("/proc/self/statm")
+            pages = int(fp.read().split()[1])
+            fp.close()
+        except (IOError, OSError, IndexError, ValueError):
+            return self.peak()
+        return pages * resource.getpagesize() / 1048576.
+
+    def workers(self):
+        """ max rss of the largest ended child process in MB """
+        return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if name not in self.index:
+            self.index[name] = len(self.stages)
+            self.stages.append({'stage': name, 'seconds': 0., 'calls': 0,
+                'delta_mb': 0., 'rss_mb': 0., 'workers_mb': 0.})
+        entry = self.stages[self.index[name]]
+        start = time.time()
+        rss = self.rss()
+        workers = self.workers()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] += time.time() - start
+            entry['calls'] += 1
+            after = self.rss()
+            entry['delta_mb'] = round(entry['delta_mb'] + after - rss, 1)
+            entry['rss_mb'] = round(after, 1)
+            # the pool workers are only counted once they are joined
+            if self.workers() > workers:
+                entry['workers_mb'] = round(self.workers(), 1)
+
+    def report(self):
+        return {'stages': [dict(s, seconds=round(s['seconds'], 4)) for s in self.stages],
+                'seconds': round(time.time() - self.start, 4),
+                'peak_mb': round(self.peak(), 1),
+                'workers_mb': round(self.workers(), 1)}
+
+    def save(self, filename, **info):
+        report = self.report()
+        report.update(info)
+        fp = open(filename, "w")
+        json.dump(report, fp, indent=1, sort_keys=True)
+        fp.close()
+
+    def printReport(self):
+        for s in self.stages:
+            vprint( "%-20s %9.3f s %+9.1f MB %9.1f MB rss %9.1f MB workers", 2, s['stage'],
+                    s['seconds'], s['delta_mb'], s['rss_mb'], s['workers_mb'])
+
+profiler = Profiler()
+
+OVERPASS_API = "http://overpass-api.de/api/interpreter"
+
+def overpassQuery(left,bottom,right,top,transport="all"):
+    """ returns the overpass query for highways and public transport in a bbox """
     bbox = "%f,%f,%f,%f"%(bottom,left,top,right)
-    localfilename = "/tmp/input.osm"
 
     hw_query = ""
     if transport == "hw" or transport == "all":
@@ -70,6 +193,7 @@ def getNetwork(left,bottom,right,top,transport="all"):
                "("+\
                    "relation("+bbox+")[type=route][route=tram];"+\
                    "relation("+bbox+")[type=route][route=bus];"+\
+                   "relation("+bbox+")[type=public_transport][public_transport=stop_area];"+\
                ");"+\
                ">>;"+\
          ");"
@@ -85,25 +209,474 @@ def getNetwork(left,bottom,right,top,transport="all"):
     if (verbose >= 1):
         meta = " meta"
 
-    api = "http://overpass-api.de/api/interpreter?data="
-    url = ""+\
+    return ""+\
     "("+\
         hw_query+\
         pt_query+\
     ");"+\
     "out"+meta+";"
 
-    vprint( api+url,2)
-
-    url = api + urllib.quote(url)
+def splitBBox(left,bottom,right,top,size):
+    """ splits a bbox into tiles of at most size degrees """
+    # 0.1/0.05 is 2.0000000000000004 - rounding errors make no extra tiles
+    nx = max(1, int(math.ceil((right-left)/size - 1e-9)))
+    ny = max(1, int(math.ceil((top-bottom)/size - 1e-9)))
+    dx = (right-left)/nx
+    dy = (top-bottom)/ny
+    return [(left+i*dx, bottom+j*dy, left+(i+1)*dx, bottom+(j+1)*dy)
+            for j in range(ny) for i in range(nx)]
 
-    fp = urlopen( url )
-    localFile = open(localfilename, 'w')
-    localFile.write(fp.read())
+def downloadTile(task):
+    """ downloads one tile to a file in chunks - an existing file is reused """
+    api, query, filename = task
+    if os.path.exists(filename):
+        vprint( "tile cached '"+filename+"'",2)
+        os.utime(filename, None) # recently used, see evictCache
+        return filename
+    vprint( api+"?data="+query,2)
+    fp = urlopen( api + "?data=" + urllib.quote(query) )
+    tmpfile = filename + ".%d.tmp" % os.getpid()
+    localFile = open(tmpfile, 'wb')
+    shutil.copyfileobj(fp, localFile, 1<<16)
     localFile.close()
     fp.close()
+    os.rename(tmpfile, filename)
+    return filename
+
+# MergeHandler
+#
+# copies all nodes, ways and relations of a file which were not copied
+# before (seen holds their type and id)
+class MergeHandler(xml.sax.ContentHandler):
+    def __init__(self, out, seen):
+        xml.sax.ContentHandler.__init__(self)
+        self.out = out
+        self.seen = seen
+        self.copy = False
+
+    def startElement(self, name, attrs):
+        if name in ('node','way','relation'):
+            key = (name, attrs['id'])
+            self.copy = key not in self.seen
+            self.seen.add(key)
+        if self.copy:
+            self.out.startElement(name, attrs)
+
+    def endElement(self, name):
+        if self.copy:
+            self.out.endElement(name)
+        if name in ('node','way','relation'):
+            self.copy = False
+
+def mergeOSM(filenames, localfilename):
+    """ merges osm files into one and removes duplicated elements
+        written to a temp file first to never leave half written files """
+    tmpfile = localfilename + ".%d.tmp" % os.getpid()
+    try:
+        fp = open(tmpfile, 'w')
+        x = XMLGenerator(fp, "UTF-8")
+        x.startDocument()
+        x.startElement('osm',{"version":"0.6","generator":"crazy py script"})
+        seen = set()
+        for fn in filenames:
+            xml.sax.parse(fn, MergeHandler(x, seen))
+        x.endElement('osm')
+        x.endDocument()
+        fp.close()
+        os.rename(tmpfile, localfilename)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+def getNetwork(left,bottom,right,top,transport="all",api=OVERPASS_API,
+        tilesize=0.05,workers=2,cachedir=None,localfilename=None,cachelimit=None):
+    """ Returns a filename to the downloaded data.
+        down loads highways and public transport
+        bigger areas are split into tiles which are downloaded by a pool of
+        workers and merged afterwards into localfilename - by default a new
+        temporary file the caller has to remove. Tiles are kept in
+        cachedir/tiles.
+    """
+    if cachedir is None:
+        tiledir = tempfile.mkdtemp(prefix="osm2graph")
+    else:
+        tiledir = os.path.join(cachedir, "tiles")
+        if not os.path.isdir(tiledir):
+            os.makedirs(tiledir)
+
+    try:
+        tasks = []
+        for l, b, r, t in splitBBox(left,bottom,right,top,tilesize):
+            query = overpassQuery(l,b,r,t,transport)
+            # the file name holds everything which changes the query
+            key = hashlib.sha1(api+query).hexdigest()
+            tasks.append((api, query, os.path.join(tiledir, key+".osm")))
+        vprint( "download "+str(len(tasks))+" tiles...",1)
+
+        pool = ThreadPool(min(workers, len(tasks)))
+        try:
+            filenames = pool.map(downloadTile, tasks)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        if localfilename is None:
+            # concurrent runs must not share the file
+            fd, tmpfile = tempfile.mkstemp(prefix="osm2graph", suffix=".osm")
+            os.close(fd)
+            try:
+                mergeOSM(filenames, tmpfile)
+            except BaseException:
+                os.remove(tmpfile)
+                raise
+            localfilename = tmpfile
+        else:
+            mergeOSM(filenames, localfilename)
+        vprint( "tiles merged to '"+localfilename+"'",2)
+    finally:
+        # the temporary tiles go on errors and interrupts, too
+        if cachedir is None:
+            shutil.rmtree(tiledir)
+
+    if cachedir is not None:
+        evictCache(cachedir, cachelimit)
     return localfilename
 
+def highwayClass(tags):
+    if "highway" in tags and tags["highway"] in HIGHWAY_CLASSES:
+        return HIGHWAY_CLASSES[tags["highway"]]
+    return 1# if unknown its a footway
+
+def access(tags):
+    """ returns (foot, bicycle) access as 0/1 """
+    foot = 1
+    if "foot" in tags and tags["foot"] == "no":
+        foot = 0
+    bike = 1
+    if "bicycle" in tags and tags["bicycle"] == "no":
+        bike = 0
+    return foot, bike
+
+def onewayDirection(tags):
+    """ 1: only along the way, -1: only against it, 0: both directions """
+    oneway = tags.get("oneway")
+    if oneway in ("yes", "true", "1"):
+        return 1
+    if oneway in ("-1", "reverse"):
+        return -1
+    if oneway is None and tags.get("junction") == "roundabout":
+        return 1
+    return 0
+
+# isNetworkWay / isNetworkRelation
+#
+# rough filters for elements which might be part of the routable network
+def isNetworkWay(way):
+    return 'highway' in way.tags or 'railway' in way.tags
+
+def isNetworkRelation(rel):
+    return 'route' in rel.tags or isStopArea(rel.tags)
+
+def isPublicTransportRoute(rel):
+    return 'route' in rel.tags and (rel.tags['route']=='tram' or\
+            rel.tags['route']=='bus')
+
+def isStop(tags):
+    return tags.get('public_transport')=='stop_position' or \
+            tags.get('railway')=='tram_stop'
+
+def isPlatform(tags):
+    return tags.get('public_transport')=='platform' or \
+            tags.get('highway') in ('bus_stop', 'platform') or \
+            tags.get('railway')=='platform'
+
+def isStopArea(tags):
+    return tags.get('type')=='public_transport' and \
+            tags.get('public_transport')=='stop_area'
+
+def isTransfer(tags):
+    return tags.get('footway')=='transfer'
+
+def osmId(wid):
+    """ the osm way of an edge, the route relation of a PT edge and 0 for a
+        transfer """
+    if wid.startswith('transfer-'):
+        return 0
+    return int(wid.rsplit("-",1)[0].replace("special-",""))
+
+# gridPairs
+#
+# finds all pairs of points of a and b closer than size without comparing
+# all of them: b is sorted by the grid cell (of size) it is in, each point of
+# a only looks at the 3x3 cells around its own one
+def gridPairs(ax, ay, bx, by, size):
+    """ returns the indexes i, j and the squared distances of the pairs """
+    acx = np.floor(ax / size).astype(np.int64)
+    acy = np.floor(ay / size).astype(np.int64)
+    bcode = np.floor(bx / size).astype(np.int64) * CELL_KEY + np.floor(by / size).astype(np.int64)
+    order = np.argsort(bcode, kind='mergesort')
+    bcode = bcode[order]
+    i = []
+    j = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            code = (acx + dx) * CELL_KEY + acy + dy
+            lo = np.searchsorted(bcode, code, 'left')
+            n = np.searchsorted(bcode, code, 'right') - lo
+            i.append(np.repeat(np.arange(len(ax)), n))
+            # the positions lo..lo+n-1 of every point one after the other
+            j.append(order[np.repeat(lo - np.cumsum(n) + n, n) + np.arange(n.sum())])
+    i = np.concatenate(i)
+    j = np.concatenate(j)
+    dist = (ax[i] - bx[j])**2 + (ay[i] - by[j])**2
+    close = dist <= size * size
+    return i[close], j[close], dist[close]
+
+# PBF
+#
+# minimal reader for the OpenStreetMap protocol buffer format
+# http://wiki.openstreetmap.org/wiki/PBF_Format
+# each fileblock is decoded on its own - so they can be handled by a process pool
+
+PBF_FEATURES = ["OsmSchema-V0.6", "DenseNodes"]
+
+def pbfVarint(buf, pos):
+    """ decodes one varint of a bytearray, returns the value and the new position """
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 128:
+            return result, pos
+        shift += 7
+
+def pbfFields(buf):
+    """ iterates over the (field number, value) pairs of a protobuf message """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = pbfVarint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = pbfVarint(buf, pos)
+        elif wire == 2:
+            size, pos = pbfVarint(buf, pos)
+            value = buf[pos:pos+size]
+            pos += size
+        elif wire == 1:
+            value = buf[pos:pos+8]
+            pos += 8
+        elif wire == 5:
+            value = buf[pos:pos+4]
+            pos += 4
+        else:
+            raise ValueError("unsupported protobuf wire type %d" % wire)
+        yield key >> 3, value
+
+def pbfInt64(value):
+    """ a negative int64 is encoded as its two's complement """
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+def pbfPacked(data, signed=False):
+    """ decodes a packed varint field at once into an int64 array """
+    a = np.frombuffer(bytes(data), dtype=np.uint8)
+    ends = np.flatnonzero(a < 128)
+    if len(ends) == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    a = a[:ends[-1]+1]
+    pos = np.arange(len(a)) - np.repeat(starts, ends - starts + 1)
+    parts = (a & 0x7f).astype(np.uint64) << (7 * pos).astype(np.uint64)
+    values = np.add.reduceat(parts, starts)
+    if signed:
+        #zigzag encoding
+        return (values >> np.uint64(1)).astype(np.int64) ^ \
+                -(values & np.uint64(1)).astype(np.int64)
+    return values.astype(np.int64)
+
+def pbfTags(keys, vals, strings):
+    return dict((strings[k], strings[v]) for k, v in zip(keys, vals))
+
+def readPBFIndex(filename):
+    """ returns (offset, size) of all data blobs in a PBF file """
+    blocks = []
+    f = open(filename, 'rb')
+    while True:
+        head = f.read(4)
+        if len(head) < 4:
+            break
+        header = bytearray(f.read(struct.unpack('>I', head)[0]))
+        btype = None
+        size = 0
+        for field, value in pbfFields(header):
+            if field == 1:
+                btype = str(value)
+            elif field == 3:
+                size = value
+        if btype == 'OSMHeader':
+            for field, value in pbfFields(readPBFBlob(f.read(size))):
+                if field == 4 and str(value) not in PBF_FEATURES:
+                    raise ValueError("PBF feature '"+str(value)+"' is not supported")
+            continue
+        if btype == 'OSMData':
+            blocks.append((f.tell(), size))
+        f.seek(size, 1)
+    f.close()
+    return blocks
+
+def readPBFBlob(data):
+    """ returns the uncompressed content of a blob """
+    for field, value in pbfFields(bytearray(data)):
+        if field == 1:
+            return value
+        elif field == 3:
+            return bytearray(zlib.decompress(bytes(value)))
+    raise ValueError("unsupported PBF blob compression")
+
+def decodePBFBlock(task):
+    """ decodes one fileblock (runs in a worker process)
+        returns nodes as (ids, lon, lat, [(id, tags)]) arrays and lists of
+        ways (id, nds, tags) and relations (id, [(type, ref, role)], tags)
+        only the element kinds given in the task are decoded
+    """
+    filename, offset, size, kinds = task
+    f = open(filename, 'rb')
+    f.seek(offset)
+    block = readPBFBlob(f.read(size))
+    f.close()
+
+    strings = []
+    groups = []
+    granularity = 100
+    lat_offset = 0
+    lon_offset = 0
+    for field, value in pbfFields(block):
+        if field == 1:
+            strings = [bytes(s).decode('utf-8') for f2, s in pbfFields(value)]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 19:
+            lat_offset = pbfInt64(value)
+        elif field == 20:
+            lon_offset = pbfInt64(value)
+
+    ids = []
+    lats = []
+    lons = []
+    tagged = []
+    ways = []
+    relations = []
+    for group in groups:
+        for field, value in pbfFields(group):
+            if field == 2 and 'nodes' in kinds:
+                dense = {}
+                for f2, v2 in pbfFields(value):
+                    dense[f2] = v2
+                nids = np.cumsum(pbfPacked(dense.get(1, ''), True))
+                ids.append(nids)
+                lats.append(np.cumsum(pbfPacked(dense.get(8, ''), True)))
+                lons.append(np.cumsum(pbfPacked(dense.get(9, ''), True)))
+                kv = pbfPacked(dense.get(10, ''))
+                if len(kv):
+                    #keys_vals: k v k v 0 for every node
+                    zeros = np.flatnonzero(kv == 0)
+                    starts = np.empty_like(zeros)
+                    starts[0] = 0
+                    starts[1:] = zeros[:-1] + 1
+                    for i in np.flatnonzero(zeros > starts):
+                        pairs = kv[starts[i]:zeros[i]]
+                        tagged.append((int(nids[i]),
+                            pbfTags(pairs[0::2], pairs[1::2], strings)))
+            elif field == 1 and 'nodes' in kinds:
+                node = {}
+                for f2, v2 in pbfFields(value):
+                    node[f2] = v2
+                nid = (node[1] >> 1) ^ -(node[1] & 1)
+                ids.append(np.array([nid], dtype=np.int64))
+                lats.append(np.array([(node[8] >> 1) ^ -(node[8] & 1)], dtype=np.int64))
+                lons.append(np.array([(node[9] >> 1) ^ -(node[9] & 1)], dtype=np.int64))
+                if 2 in node:
+                    tagged.append((nid, pbfTags(pbfPacked(node[2]),
+                        pbfPacked(node.get(3, '')), strings)))
+            elif field == 3 and 'ways' in kinds:
+                way = {}
+                for f2, v2 in pbfFields(value):
+                    way[f2] = v2
+                nds = [str(n) for n in np.cumsum(pbfPacked(way.get(8, ''), True))]
+                tags = pbfTags(pbfPacked(way.get(2, '')), pbfPacked(way.get(3, '')), strings)
+                ways.append((str(way[1]), nds, tags))
+            elif field == 4 and 'relations' in kinds:
+                rel = {}
+                for f2, v2 in pbfFields(value):
+                    rel[f2] = v2
+                roles = pbfPacked(rel.get(8, ''))
+                memids = np.cumsum(pbfPacked(rel.get(9, ''), True))
+                types = pbfPacked(rel.get(10, ''))
+                members = [(int(t), str(m), strings[r])
+                        for t, m, r in zip(types, memids, roles)]
+                tags = pbfTags(pbfPacked(rel.get(2, '')), pbfPacked(rel.get(3, '')), strings)
+                relations.append((str(rel[1]), members, tags))
+
+    nodes = None
+    if ids:
+        ids = np.concatenate(ids)
+        #nanodegrees - dividing keeps them exact to the last digit
+        lat = (lat_offset + granularity * np.concatenate(lats)) / 1e9
+        lon = (lon_offset + granularity * np.concatenate(lons)) / 1e9
+        nodes = (ids, lon, lat, tagged)
+    return nodes, ways, relations
+
+# FrozenTags
+#
+# an immutable tag dict, so equal tag sets can be shared by many elements
+# the items are inserted sorted - equal sets iterate in the same order
+class FrozenTags(dict):
+    __slots__ = ('hash',)
+
+    def __init__(self, tags=()):
+        dict.__init__(self, sorted(dict(tags).iteritems()))
+        self.hash = hash(frozenset(self.iteritems()))
+
+    def __hash__(self):
+        return self.hash
+
+    def __reduce__(self):
+        return (FrozenTags, (dict(self),))
+
+    def immutable(self, *args, **kwargs):
+        raise TypeError("tags are shared and can not be changed - build a new dict")
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = immutable
+
+# TagTable
+#
+# interns the tag sets of all elements: every combination of tags is stored
+# once as FrozenTags and the keys and values once as strings
+class TagTable:
+    def __init__(self):
+        self.sets = {} # frozenset of the items: FrozenTags
+        self.strings = {}
+
+    def __len__(self):
+        return len(self.sets)
+
+    def intern(self, tags):
+        """ returns the shared FrozenTags equal to the dict tags
+            looked up by the frozenset of the items - FrozenTags are only
+            built for new sets """
+        shared = self.sets.get(frozenset(tags.iteritems()))
+        if shared is None:
+            string = self.strings.setdefault
+            shared = FrozenTags((string(k, k), string(v, v)) for k, v in tags.iteritems())
+            self.sets[frozenset(shared.iteritems())] = shared
+        return shared
 
 # Node
 #
@@ -141,7 +714,180 @@ class Node:
         if frame:
             x.endElement('osm')
             x.endDocument()
-        
+
+# NodeStore
+#
+# compact table of all nodes - ids and coordinates are kept in numpy arrays
+# (sorted by id after reading), tags only for the few nodes which have some.
+# Looking up a node returns a read only Node object created on the fly.
+class NodeStore:
+    BLOCK = 1 << 16 # nodes collected by append before they are stored
+
+    def __init__(self, size=1024):
+        self.count = 0
+        self.ids = np.empty(size, dtype=np.int64)
+        self.lon = np.empty(size, dtype=np.float64)
+        self.lat = np.empty(size, dtype=np.float64)
+        self.tags = {} # int id: tags - only for tagged nodes
+        self.sorted = True
+        self.pending = ([], [], []) # ids, lon and lat of append
+
+    def add(self, id, lon, lat, tags=None):
+        n = self.count
+        if n == len(self.ids):
+            self.resize(max(2*n, 1024))
+        id = int(id)
+        if n > 0 and id <= self.ids[n-1]:
+            self.sorted = False
+        self.ids[n] = id
+        self.lon[n] = lon
+        self.lat[n] = lat
+        self.count += 1
+        if tags:
+            self.tags[id] = tags
+
+    # like add, but the nodes are collected in lists and appended in blocks
+    # by extend - much faster while reading, freeze appends the rest
+    def append(self, id, lon, lat, tags=None):
+        ids, lons, lats = self.pending
+        id = int(id)
+        ids.append(id)
+        lons.append(lon)
+        lats.append(lat)
+        if tags:
+            self.tags[id] = tags
+        if len(ids) == self.BLOCK:
+            self.flush()
+
+    def flush(self):
+        ids, lons, lats = self.pending
+        if ids:
+            self.extend(np.array(ids, dtype=np.int64), lons, lats)
+            del ids[:], lons[:], lats[:]
+
+    # appends whole arrays of nodes at once
+    def extend(self, ids, lon, lat):
+        n = self.count
+        if n + len(ids) > len(self.ids):
+            self.resize(max(2*n, n+len(ids), 1024))
+        if len(ids) > 0 and (np.any(ids[1:] <= ids[:-1]) or
+                (n > 0 and ids[0] <= self.ids[n-1])):
+            self.sorted = False
+        self.ids[n:n+len(ids)] = ids
+        self.lon[n:n+len(ids)] = lon
+        self.lat[n:n+len(ids)] = lat
+        self.count += len(ids)
+
+    def resize(self, size):
+        self.ids.resize(size, refcheck=False)
+        self.lon.resize(size, refcheck=False)
+        self.lat.resize(size, refcheck=False)
+
+    # sorts the table by id to be able to use a binary search
+    # if a node was added twice the last one wins
+    def freeze(self):
+        self.flush()
+        if len(self.ids) != self.count:
+            self.resize(self.count)
+        if self.sorted:
+            return
+        order = np.argsort(self.ids, kind='mergesort')
+        ids = self.ids[order]
+        last = np.ones(len(ids), dtype=bool)
+        last[:-1] = ids[1:] != ids[:-1]
+        order = order[last]
+        self.ids = ids[last]
+        self.lon = self.lon[order]
+        self.lat = self.lat[order]
+        self.count = len(self.ids)
+        self.sorted = True
+
+    # returns the array index of a node id
+    def index(self, nid):
+        if not self.sorted or len(self.ids) != self.count:
+            self.freeze()
+        id = int(nid)
+        i = int(np.searchsorted(self.ids, id))
+        if i == self.count or self.ids[i] != id:
+            raise KeyError(nid)
+        return i
+
+    # returns the array indexes of many node ids at once
+    def indices(self, nids, count=-1):
+        if not self.sorted or len(self.ids) != self.count:
+            self.freeze()
+        ids = np.fromiter((int(nid) for nid in nids), np.int64, count)
+        idx = np.searchsorted(self.ids, ids)
+        idx[idx == self.count] = 0
+        missing = np.flatnonzero(self.ids[idx] != ids) if self.count else np.arange(len(ids))
+        if len(missing):
+            raise KeyError(str(ids[missing[0]]))
+        return idx
+
+    # adds new nodes and moves existing ones (Node objects with unique ids),
+    # the table stays sorted
+    def update(self, nodes):
+        self.freeze()
+        ids = np.fromiter((int(n.id) for n in nodes), np.int64, len(nodes))
+        lon = np.fromiter((n.lon for n in nodes), np.float64, len(nodes))
+        lat = np.fromiter((n.lat for n in nodes), np.float64, len(nodes))
+        idx = np.searchsorted(self.ids, ids)
+        found = np.zeros(len(ids), dtype=bool)
+        inside = idx < self.count
+        found[inside] = self.ids[idx[inside]] == ids[inside]
+        self.lon[idx[found]] = lon[found]
+        self.lat[idx[found]] = lat[found]
+
+        new = np.flatnonzero(~found)
+        new = new[np.argsort(ids[new], kind='mergesort')]
+        self.ids = np.insert(self.ids, idx[new], ids[new])
+        self.lon = np.insert(self.lon, idx[new], lon[new])
+        self.lat = np.insert(self.lat, idx[new], lat[new])
+        self.count = len(self.ids)
+
+        for n in nodes:
+            if n.tags:
+                self.tags[int(n.id)] = n.tags
+            else:
+                self.tags.pop(int(n.id), None)
+
+    def remove(self, nids):
+        nids = list(nids)
+        idx = self.indices(nids, len(nids))
+        self.ids = np.delete(self.ids, idx)
+        self.lon = np.delete(self.lon, idx)
+        self.lat = np.delete(self.lat, idx)
+        self.count = len(self.ids)
+        for nid in nids:
+            self.tags.pop(int(nid), None)
+
+    # returns local coordinates in km of many node ids (equirectangular,
+    # only usable for short distances)
+    def project(self, nids):
+        idx = self.indices(nids, len(nids))
+        lat = self.lat[idx]
+        return self.lon[idx] * KM_PER_DEGREE * np.cos(np.radians(lat)), lat * KM_PER_DEGREE
+
+    def checkTag(self, nid, k, v):
+        tags = self.tags.get(int(nid))
+        return tags is not None and k in tags and tags[k]==v
+
+    def __getitem__(self, nid):
+        i = self.index(nid)
+        node = Node(nid, float(self.lon[i]), float(self.lat[i]))
+        node.tags = self.tags.get(int(nid), {})
+        return node
+
+    def __contains__(self, nid):
+        try:
+            self.index(nid)
+        except (KeyError, ValueError):
+            return False
+        return True
+
+    def __len__(self):
+        return self.count
+
 # Way
 #
 # a class which represent graph edges
@@ -152,36 +898,41 @@ class Way:
         self.id = id
         self.nds = []
         self.tags = {}
+        self.length = None # in km - filled by OSM.computeLengths
 
-    def split(self, dividers,ec):
-        # slice the node-array using this nifty recursive function
-        def slice_array(ar, dividers):
-            for i in range(1,len(ar)-1):
-                if dividers[ar[i]]>1:
-                    #vprint( "slice at %s"%ar[i],2)
-                    left = ar[:i+1]
-                    right = ar[i:]
-                    
-                    rightsliced = slice_array(right, dividers)
-                    
-                    return [left]+rightsliced
-            return [ar]
-            
-        slices = slice_array(self.nds, dividers)
-        
-        # create a way object for each node-array slice
+    # returns the (first, last) node index of each part of this way after
+    # cutting it at every inner node in the set dividers
+    # single pass - the parts share their end nodes
+    def splitRanges(self, dividers):
+        ranges = []
+        first = 0
+        nds = self.nds
+        for i in xrange(1,len(nds)-1):
+            if nds[i] in dividers:
+                ranges.append((first, i))
+                first = i
+        ranges.append((first, len(nds)-1))
+        return ranges
+
+    def split(self, dividers):
+        return self.parts(self.splitRanges(dividers))
+
+    def parts(self, ranges):
+        # create a way object for each part, the k-th part is named <id>-<k>
+        # so the ids do not depend on the order the ways are split in
+        # built directly - copy.copy took most of the time of the split
         ret = []
-        for slice in slices:
-            littleway = copy.copy( self )
-            littleway.id += "-"+str(ec)
-            littleway.nds = slice
+        for k, (first, last) in enumerate(ranges):
+            littleway = Way("%s-%d" % (self.id, k), self.osm)
+            littleway.nds = self.nds[first:last+1]
+            littleway.tags = self.tags
             ret.append( littleway )
-            ec += 1
             
         return ret
 
     # creates a osm-xml way object
-    def toOSM(self,x):
+    # id is the exported (negative) way id, default the part number
+    def toOSM(self,x,id=None):
         # Generate SAX events
         frame = False
         if x == None :
@@ -191,7 +942,9 @@ class Way:
             x.startDocument()
             x.startElement('osm',{"version":"0.6"})
 
-        x.startElement('way',{"id":"-"+self.id.split("-",2)[1]})
+        if id is None:
+            id = "-"+self.id.rsplit("-",1)[1]
+        x.startElement('way',{"id":id})
         
         #bad but for rendering ok
         #x.startElement('way',{"id":self.id.replace("special","").split("-",2)[0]})
@@ -265,7 +1018,242 @@ class Route:
         self.platforms = []
         self.ways = []
         self.tags = {}
-        
+
+# ElementHandler
+#
+# SAX handler which passes every finished element to a callback
+# and keeps nothing itself - used by the streaming passes
+# only the tags with a key in keep are stored (None keeps all)
+class ElementHandler(xml.sax.ContentHandler):
+    def __init__(self, osm, onNode=None, onWay=None, onRelation=None, keep=None):
+        xml.sax.ContentHandler.__init__(self)
+        self.osm = osm
+        self.keep = keep
+        self.onNode = onNode
+        self.onWay = onWay
+        self.onRelation = onRelation
+        self.currElem = None
+
+    def startElement(self, name, attrs):
+        if name=='node':
+            if self.onNode is None:
+                self.currElem = None
+            else:
+                self.currElem = Node(attrs['id'], float(attrs['lon']), float(attrs['lat']))
+        elif name=='way':
+            if self.onWay is None:
+                self.currElem = None
+            else:
+                self.currElem = Way(attrs['id'], self.osm)
+        elif name=='relation':
+            if self.onRelation is None:
+                self.currElem = None
+            else:
+                self.currElem = Relation(attrs['id'], self.osm)
+        elif self.currElem is None:
+            #child of a skipped element
+            return
+        elif name=='tag':
+            if self.keep is None or attrs['k'] in self.keep:
+                self.currElem.tags[attrs['k']] = attrs['v']
+        elif name=='nd':
+            self.currElem.nds.append( attrs['ref'] )
+        elif name=='member':
+            if attrs['type']=='node':
+                self.currElem.mnode.append({attrs['ref']:attrs['role']})
+            elif attrs['type']=='way':
+                self.currElem.mway.append({attrs['ref'] : attrs['role']})
+            elif attrs['type']=='relation':
+                self.currElem.mrelation.append({attrs['ref']:attrs['role']})
+
+    def endElement(self,name):
+        if self.currElem is None:
+            return
+        if name=='node':
+            self.onNode(self.currElem)
+        elif name=='way':
+            self.onWay(self.currElem)
+        elif name=='relation':
+            self.onRelation(self.currElem)
+        else:
+            return
+        self.currElem = None
+
+# expat parser
+#
+# reads OSM xml straight from the expat callbacks - much faster than the SAX
+# handlers. Only the tags with a key in keep are stored (None keeps all),
+# PARSE_TAGS are the ones the conversion itself needs (--filter-tags).
+# An element is passed on when the next one starts, so closing tags need no
+# callback: onNode(id, lon, lat, tags), onWay(way) and onRelation(rel)
+PARSE_TAGS = frozenset(['highway', 'railway', 'public_transport', 'route', 'type',
+        'name', 'ref', 'oneway', 'junction', 'foot', 'bicycle', 'access',
+        'bus', 'tram', 'maxspeed', 'area'])
+
+def parseOSM(source, osm, onNode=None, onWay=None, onRelation=None, keep=None):
+    """ parses a file object or filename with expat """
+    # the element being read: kind, element, its tags and the append of its
+    # node list - nodes are (id, lon, lat) tuples, skipped elements have the
+    # kind None
+    current = [None, None, None, None]
+    # expat returns utf-8 encoded str, ids and coordinates are ascii, only
+    # the tags and roles are decoded - the keys once
+    keys = {}
+
+    def finish():
+        kind, elem, tags = current[0], current[1], current[2]
+        if kind == 'node':
+            onNode(elem[0], elem[1], elem[2], tags)
+        elif kind == 'way':
+            onWay(elem)
+        elif kind == 'relation':
+            onRelation(elem)
+        current[0] = current[1] = current[2] = current[3] = None
+
+    def start(name, attrs):
+        if name == 'nd':
+            append = current[3]
+            if append is not None:
+                append(attrs['ref'])
+        elif name == 'tag':
+            if current[0] is not None:
+                k = attrs['k']
+                if keep is None or k in keep:
+                    key = keys.get(k)
+                    if key is None:
+                        key = keys[k] = unicode(k, 'utf-8')
+                    current[2][key] = unicode(attrs['v'], 'utf-8')
+        elif name == 'member':
+            if current[0] is not None:
+                kind = attrs['type']
+                member = {attrs['ref']:unicode(attrs['role'], 'utf-8')}
+                if kind == 'node':
+                    current[1].mnode.append(member)
+                elif kind == 'way':
+                    current[1].mway.append(member)
+                elif kind == 'relation':
+                    current[1].mrelation.append(member)
+        else:
+            if current[0] is not None:
+                finish()
+            if name == 'node':
+                if onNode is not None:
+                    current[0] = 'node'
+                    current[1] = (attrs['id'], float(attrs['lon']), float(attrs['lat']))
+                    current[2] = {}
+            elif name == 'way':
+                if onWay is not None:
+                    way = Way(attrs['id'], osm)
+                    current[0], current[1], current[2] = 'way', way, way.tags
+                    current[3] = way.nds.append
+            elif name == 'relation':
+                if onRelation is not None:
+                    rel = Relation(attrs['id'], osm)
+                    current[0], current[1], current[2] = 'relation', rel, rel.tags
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.returns_unicode = False
+    parser.StartElementHandler = start
+    if isinstance(source, basestring):
+        with open(source, 'rb') as fp:
+            parser.ParseFile(fp)
+    else:
+        parser.ParseFile(source)
+    if current[0] is not None:
+        finish()
+
+# ChangeHandler
+#
+# SAX handler for osmChange files (.osc) - passes every finished element with
+# its action (create, modify or delete) to a callback
+class ChangeHandler(ElementHandler):
+    def __init__(self, osm, onChange, keep=None):
+        ElementHandler.__init__(self, osm,
+                lambda e: onChange(self.action, 'node', e),
+                lambda e: onChange(self.action, 'way', e),
+                lambda e: onChange(self.action, 'relation', e), keep)
+        self.action = None
+
+    def startElement(self, name, attrs):
+        if name in ('create', 'modify', 'delete'):
+            self.action = name
+        elif name == 'node' and 'lat' not in attrs:
+            #deleted nodes may come without coordinates
+            self.currElem = Node(attrs['id'], None, None)
+        else:
+            ElementHandler.startElement(self, name, attrs)
+
+# sharded stages
+#
+# splitting the ways and building the PT edges run on chunks of way or
+# relation ids in a pool of processes. The OSM object is stored in shardOSM
+# before the pool is forked, so the workers inherit it instead of getting it
+# pickled. The chunks are merged in order, which makes the result the same
+# for every number of processes.
+shardOSM = None
+shardData = None
+SHARD_MIN = 10000 # fewer items are not worth starting a pool
+
+def shardMap(function, items, processes=None):
+    """ returns the results of function for chunks of items in order
+        processes=1 or a few items run it in this process """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    # a few chunks per process to even out the load
+    size = max(1, len(items) // (4 * processes))
+    chunks = [items[i:i+size] for i in xrange(0, len(items), size)]
+    if processes == 1 or len(items) < SHARD_MIN:
+        return map(function, chunks)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(function, chunks)
+    finally:
+        # stops the workers on errors and interrupts, too
+        pool.terminate()
+        pool.join()
+
+@contextlib.contextmanager
+def gcPaused():
+    """ pauses the cyclic garbage collector while many objects are created
+        which live on - its full collections scan all of them again and
+        again (about half of the time of splitting the ways) """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def histogramShard(wids):
+    # the node ids used by the ways and their number of uses, as arrays -
+    # they are sent back much faster than sets of id strings
+    ways = shardOSM.ways
+    uses = {}
+    get = uses.get
+    for wid in wids:
+        for nid in ways[wid].nds:
+            uses[nid] = get(nid,0) + 1
+    ids = np.fromiter((int(nid) for nid in uses.iterkeys()), np.int64, len(uses))
+    return ids, np.fromiter(uses.itervalues(), np.int64, len(uses))
+
+def splitShard(wids):
+    ways = shardOSM.ways
+    return [(wid, ways[wid].splitRanges(shardData)) for wid in wids]
+
+def routeShard(rids):
+    # the errors are counted by the caller
+    global errors
+    results = []
+    for rid in rids:
+        rel = shardOSM.relations[rid]
+        before = errors
+        route_ways = {}
+        shardOSM.route2edges(rel, route_ways)
+        results.append((rid, route_ways.values(), errors - before))
+        errors = before
+    return results
+
 # OSM
 #
 # class to handel all tasks
@@ -274,12 +1262,25 @@ class Route:
 # provide export functionalities
 class OSM:
     """ will parse a osm xml file and provide different export functions"""
-    def __init__(self, filename_or_stream, transport):
-        """ File can be either a filename or stream/file object."""
+    def __init__(self, filename_or_stream, transport, streaming=False, processes=None,
+            parser="expat", keep=None):
+        """ File can be either a filename or stream/file object.
+            With streaming the input is read twice (it has to be a file) and
+            only nodes used by the routable network are kept in memory.
+            Files ending with .pbf are read in the PBF format by a pool of
+            processes (default: one per cpu), the ways are split and the PT
+            edges are built by such a pool for every input.
+            The xml parser is "expat" or the old "sax" one. Both read
+            everything, with a set of tag keys keep expat only keeps these
+            tags, the network ways and the route relations - the nodes other
+            ways share with the network do not split it then."""
         vprint( "Start reading input...",2)
-        nodes = {} # node objects
+        self.tagTable = TagTable() # the shared tag sets of all elements
+        # streaming: OSM way id: the network nodes used by a way which is
+        # not part of the network - they split the network ways as well
+        self.outsideWays = {}
+        nodes = NodeStore() # node table
         ways = {}# way objects
-        vways ={}# old ID: [list of new way IDs] to use relations
         relations = {} # relation objects
         
         superself = self
@@ -325,7 +1326,8 @@ class OSM:
             @classmethod
             def endElement(self,name):
                 if name=='node':
-                    nodes[self.currElem.id] = self.currElem
+                    nodes.add(self.currElem.id, self.currElem.lon,
+                            self.currElem.lat, self.currElem.tags)
                 elif name=='way':
                     ways[self.currElem.id] = self.currElem
                 elif name=='relation':
@@ -335,15 +1337,30 @@ class OSM:
             def characters(self, chars):
                 pass
 
-        xml.sax.parse(filename_or_stream, OSMHandler)
-        
+        name = getattr(filename_or_stream, 'name', filename_or_stream)
+        pbf = isinstance(name, basestring) and name.endswith('.pbf')
+        if pbf or parser != "expat":
+            keep = None
+        start = time.time()
+        with profiler.stage("parse"):
+            if pbf:
+                nodes, ways, relations = self.readPBF(name, transport, streaming, processes)
+            elif streaming:
+                nodes, ways, relations = self.readStreaming(filename_or_stream, transport,
+                        parser, keep)
+            elif parser == "expat":
+                nodes, ways, relations = self.readExpat(filename_or_stream, keep)
+            else:
+                xml.sax.parse(filename_or_stream, OSMHandler)
+
+            nodes.freeze()
+            self.internTags(nodes, ways, relations)
+        if isinstance(name, basestring) and os.path.isfile(name):
+            vprint( "parsed %.1f MB/s",2, os.path.getsize(name) / 1e6 / max(time.time() - start, 1e-6))
         self.nodes = nodes
         self.ways = ways
         self.relations = relations
 
-        # edge counter - to generate continues numbered new edge ids
-        ec = 0
-
         vprint( "file reading finished",1)
         vprint( "\nnodes: "+str(len(nodes)),1)
         vprint( "ways: "+str(len(ways)),1)
@@ -351,37 +1368,297 @@ class OSM:
 
             
         """ prepare ways for routing """
-        #count times each node is used
-        node_histogram = dict.fromkeys( self.nodes.keys(), 0 )
-        for way in self.ways.values():
-            if len(way.nds) < 2:       #if a way has only one node, delete it out of the osm collection
-                del self.ways[way.id]
-            else:
-                for node in way.nds:
-                    #count public_transport=stop_position extra (to ensure a way split there)
-                    if (transport=="all" or transport=="pt") and (\
-                        nodes[node].checkTag('public_transport','stop_position') or 
-                        nodes[node].checkTag('railway','tram_stop')):
-                        node_histogram[node] += 2
-                    else:
-                        node_histogram[node] += 1
+        #find the nodes used more than once
+        with profiler.stage("histogram"):
+            dividers = self.dividerNodes(transport, processes)
 
-        
-        #use that histogram to split all ways, replacing the member set of ways
+        #split all ways there, replacing the member set of ways
+        with profiler.stage("split"):
+            self.splitWays(dividers, processes)
+
+        # what update needs to rebuild parts of the graph
+        self.transport = transport
+        self.streaming = streaming
+        self.keep = keep
+        self.routeEdges = {} # relation id: ids of its PT edges
+        self.routeMembers = {} # relation id: members before simplifyRoute
+        self.nodeWays = None # reverse indexes, built by the first update
+        self.wayRoutes = None
+        self.transferEdges = [] # ids of the walking transfer edges
+
+        if not transport=="hw":
+            with profiler.stage("public_transport"):
+                self.addPublicTransport(processes)
+            with profiler.stage("transfers"):
+                self.addTransfers()
+
+        with profiler.stage("lengths"):
+            self.computeLengths()
+
+
+    def stopNodes(self):
+        """ returns the ids of all stop position nodes """
+        stops = set()
+        for id, tags in self.nodes.tags.iteritems():
+            if isStop(tags):
+                stops.add(str(id))
+        return stops
+
+    def internTags(self, nodes, ways, relations):
+        """ replaces the tags of all elements by the shared ones """
+        intern = self.tagTable.intern
+        for id, tags in nodes.tags.iteritems():
+            nodes.tags[id] = intern(tags)
+        for way in ways.itervalues():
+            way.tags = intern(way.tags)
+        for rel in relations.itervalues():
+            rel.tags = intern(rel.tags)
+        vprint( "%d different tag sets",2, len(self.tagTable))
+
+    def dividerNodes(self, transport, processes=None):
+        """ returns the ids of the nodes the ways are split at: the nodes used
+            more than once and the stop positions
+            the uses are counted in chunks by a pool of processes
+            ways with less than 2 nodes are deleted
+        """
+        global shardOSM
+        stops = set()
+        if transport=="all" or transport=="pt":
+            stops = self.stopNodes()
+
+        for wid in [wid for wid, way in self.ways.iteritems() if len(way.nds) < 2]:
+            del self.ways[wid]     #if a way has only one node, delete it out of the osm collection
+
+        shardOSM = self
+        try:
+            chunks = shardMap(histogramShard, self.ways.keys(), processes)
+        finally:
+            shardOSM = None
+        # the uses by ways off the network, which streaming did not keep
+        outside = [int(nid) for nds in self.outsideWays.itervalues() for nid in nds]
+        chunks.append((np.array(outside, np.int64), np.ones(len(outside), np.int64)))
+        # the uses of a node in all chunks are added up
+        empty = [np.empty(0, np.int64)]
+        ids = np.concatenate([chunk[0] for chunk in chunks] or empty)
+        uses = np.concatenate([chunk[1] for chunk in chunks] or empty)
+        ids, inverse = np.unique(ids, return_inverse=True)
+        multi = ids[np.bincount(inverse, uses) > 1]
+        return set(map(str, multi.tolist())) | stops
+
+    def splitWays(self, dividers, processes=None):
+        """ splits all ways at the dividers, the ranges are computed by a pool
+            of processes """
+        global shardOSM, shardData
+        shardOSM, shardData = self, dividers
+        try:
+            chunks = shardMap(splitShard, self.ways.keys(), processes)
+        finally:
+            shardOSM = shardData = None
         new_ways = {}
-        for id, way in self.ways.iteritems():
-            split_ways = way.split(node_histogram,ec)
-            ec += len(split_ways) #increase the counter 
-            vways[way.id]=[]#lockup to convert old to new ids
-            for split_way in split_ways:
-                new_ways[split_way.id] = split_way
-                vways[way.id].append(split_way.id)
+        vways = {} # old ID: [list of new way IDs] to use relations
+        with gcPaused():
+            for chunk in chunks:
+                for wid, ranges in chunk:
+                    vways[wid] = []
+                    for split_way in self.ways[wid].parts(ranges):
+                        new_ways[split_way.id] = split_way
+                        vways[wid].append(split_way.id)
         self.ways = new_ways
         self.vways = vways
 
+    def readExpat(self, filename_or_stream, keep):
+        """ reads the input with the expat parser
+            with the tag whitelist keep only the network ways and route
+            relations are kept - without (None) everything as by sax
+        """
+        nodes = NodeStore()
+        ways = {}
+        relations = {}
+
+        def keepWay(way):
+            if keep is None or isNetworkWay(way):
+                ways[way.id] = way
+
+        def keepRelation(rel):
+            if keep is None or isNetworkRelation(rel):
+                relations[rel.id] = rel
+
+        parseOSM(filename_or_stream, self, nodes.append, keepWay, keepRelation, keep)
+        return nodes, ways, relations
+
+    def readStreaming(self, filename_or_stream, transport, parser="sax", keep=None):
+        """ reads the input in two passes
+            1. pass: ways and route relations, remembers all used node ids
+            2. pass: only the nodes used by the kept ways and relations, and
+               the uses of these nodes by the other ways (outsideWays) -
+               without keep they split the network as in a normal build
+        """
+        #the sax parser closes streams - so read a file twice by its name
+        if hasattr(filename_or_stream, 'name'):
+            filename_or_stream = filename_or_stream.name
+
+        ways = {}
+        relations = {}
+
+        def keepWay(way):
+            if isNetworkWay(way):
+                ways[way.id] = way
+
+        def keepRelation(rel):
+            if isNetworkRelation(rel):
+                relations[rel.id] = rel
+
+        vprint( "1. pass: reading ways and relations...",2)
+        if parser == "expat":
+            parseOSM(filename_or_stream, self, None, keepWay, keepRelation, keep)
+        else:
+            xml.sax.parse(filename_or_stream,
+                    ElementHandler(self, onWay=keepWay, onRelation=keepRelation))
+
+        needed = self.filterNetwork(ways, relations, transport)
+
+        nodes = NodeStore()
+        pt = transport != "hw"
+        def keepNode(nid, lon, lat, tags):
+            if nid in needed or pt and tags and (isStop(tags) or isPlatform(tags)):
+                nodes.append(nid, lon, lat, tags)
+
+        outsideWay = None
+        if keep is None:
+            def outsideWay(way):
+                if way.id not in ways:
+                    self.addOutsideWay(way, needed)
+
+        vprint( "2. pass: reading "+str(len(needed))+" used nodes...",2)
+        if parser == "expat":
+            parseOSM(filename_or_stream, self, keepNode, outsideWay, keep=keep)
+        else:
+            xml.sax.parse(filename_or_stream, ElementHandler(self,
+                    onNode=lambda n: keepNode(n.id, n.lon, n.lat, n.tags),
+                    onWay=outsideWay))
+
+        return nodes, ways, relations
+
+    def addOutsideWay(self, way, network):
+        """ remembers the uses of the nodes in network by a way which is not
+            kept - ways with less than 2 nodes are not counted, as in
+            dividerNodes """
+        if len(way.nds) < 2:
+            return
+        nds = [nid for nid in way.nds if nid in network]
+        if nds:
+            self.outsideWays[way.id] = nds
+
+    def filterNetwork(self, ways, relations, transport):
+        """ drops all ways which are not part of the routable network
+            returns the set of node ids used by the remaining ways and
+            relations
+        """
+        #ways used by route relations
+        members = set()
+        if not transport=="hw":
+            for r in relations.itervalues():
+                if 'route' not in r.tags:
+                    continue
+                for m in r.mway:
+                    members.update(m.iterkeys())
+
+        for wid in ways.keys():
+            if not ((transport!="pt" and 'highway' in ways[wid].tags) or
+                    wid in members):
+                del ways[wid]
+
+        needed = set()
+        for way in ways.itervalues():
+            needed.update(way.nds)
         if not transport=="hw":
-            self.addPublicTransport(ec)
+            for r in relations.itervalues():
+                for m in r.mnode:
+                    needed.update(m.iterkeys())
+        return needed
+
+    def readPBF(self, filename, transport, streaming=False, processes=None):
+        """ reads an .osm.pbf file, the fileblocks are decoded in a process pool
+            with streaming the nodes are decoded in a second pass and only
+            the used ones are kept
+        """
+        blocks = readPBFIndex(filename)
+        vprint( str(len(blocks))+" PBF blocks found",2)
+        if processes == 1:
+            return self.decodePBF(filename, blocks, itertools.imap, transport, streaming)
+        # the workers are stopped on errors and interrupts, too
+        pool = multiprocessing.Pool(processes)
+        try:
+            return self.decodePBF(filename, blocks, pool.imap, transport, streaming)
+        finally:
+            pool.terminate()
+            pool.join()
 
+    def decodePBF(self, filename, blocks, imap, transport, streaming):
+        """ decodes the blocks of readPBF with imap """
+        nodes = NodeStore()
+        ways = {}
+        relations = {}
+        if streaming:
+            kinds = ('ways','relations')
+        else:
+            kinds = ('nodes','ways','relations')
+
+        vprint( "decoding "+", ".join(kinds)+"...",2)
+        tasks = [(filename, offset, size, kinds) for offset, size in blocks]
+        for bnodes, bways, brelations in imap(decodePBFBlock, tasks):
+            if bnodes is not None:
+                ids, lon, lat, tagged = bnodes
+                nodes.extend(ids, lon, lat)
+                for id, tags in tagged:
+                    nodes.tags[id] = tags
+            for id, nds, tags in bways:
+                way = Way(id, self)
+                way.nds = nds
+                way.tags = tags
+                if not streaming or isNetworkWay(way):
+                    ways[id] = way
+            for id, members, tags in brelations:
+                rel = Relation(id, self)
+                for mtype, ref, role in members:
+                    if mtype == 0:
+                        rel.mnode.append({ref:role})
+                    elif mtype == 1:
+                        rel.mway.append({ref:role})
+                    elif mtype == 2:
+                        rel.mrelation.append({ref:role})
+                rel.tags = tags
+                if not streaming or isNetworkRelation(rel):
+                    relations[id] = rel
+
+        if streaming:
+            network = self.filterNetwork(ways, relations, transport)
+            vprint( "2. pass: decoding "+str(len(network))+" used nodes...",2)
+            needed = np.array(sorted(int(nid) for nid in network), dtype=np.int64)
+            tasks = [(filename, offset, size, ('nodes','ways')) for offset, size in blocks]
+            for bnodes, bways, brelations in imap(decodePBFBlock, tasks):
+                for id, nds, tags in bways:
+                    if id not in ways:
+                        way = Way(id, self)
+                        way.nds = nds
+                        self.addOutsideWay(way, network)
+                if bnodes is None:
+                    continue
+                ids, lon, lat, tagged = bnodes
+                # the stops and platforms are kept for the transfers
+                if transport != "hw":
+                    points = [id for id, tags in tagged if isStop(tags) or isPlatform(tags)]
+                else:
+                    points = []
+                keep = np.in1d(ids, needed, assume_unique=True) | np.in1d(ids, points)
+                nodes.extend(ids[keep], lon[keep], lat[keep])
+                points = set(points)
+                for id, tags in tagged:
+                    i = np.searchsorted(needed, id)
+                    if i < len(needed) and needed[i] == id or id in points:
+                        nodes.tags[id] = tags
+
+        return nodes, ways, relations
 
     def checkPublicTransport(self):
         """ analyses which of the route relation is tagged correctly """
@@ -400,36 +1677,65 @@ class OSM:
         return routes
 
 
-    def addPublicTransport(self,ec):
-        """ prepare route relations for routing """
+    def addPublicTransport(self, processes=None):
+        """ prepare route relations for routing
+            the edges of the routes are built by a pool of processes """
         # error counter
-        global errors
+        global errors, shardOSM
         
 #TODO check if its well tagged before trying to add
-        new_ways = {}
+        routes = []
         for r in self.relations.itervalues():
-            if not ('route' in r.tags and (r.tags['route']=='tram' or\
-                    r.tags['route']=='bus')):
+            if not isPublicTransportRoute(r):
                 continue
+            self.routeMembers[r.id] = (list(r.mnode), list(r.mway), list(r.mrelation))
+            routes.append(r.id)
+        # sub routes are shared, so they are simplified before the pool starts
+        for rid in routes:
+            self.simplifyRoute(self.relations[rid])
 
-            self.simplifyRoute(r)
-            # parse this route and add the edges
-            ec = self.route2edges(r, new_ways, ec)
+        shardOSM = self
+        try:
+            chunks = shardMap(routeShard, routes, processes)
+        finally:
+            shardOSM = None
+        new_ways = {}
+        for chunk in chunks:
+            for rid, route_ways, route_errors in chunk:
+                self.routeEdges[rid] = [w.id for w in route_ways]
+                for w in route_ways:
+                    # the workers interned the tags in their copy of the table
+                    w.tags = self.tagTable.intern(w.tags)
+                    new_ways[w.id] = w
+                errors += route_errors
 
         # add all new edges to the old ways
-        vprint( "new and old ways",3)
-        vprint( new_ways.keys(),3)
-        vprint( self.ways.keys(),3)
+        if verbose >= 3:
+            vprint( "new and old ways",3)
+            vprint( new_ways.keys(),3)
+            vprint( self.ways.keys(),3)
         self.ways.update(new_ways)
-        vprint( str(errors)+" Errors found\n",1)
+        vprint( "%d Errors found\n",1, errors)
+
+    def addRoute(self, rel, new_ways):
+        """ adds the PT edges of one route relation to new_ways and notes them
+            for update """
+        self.routeMembers[rel.id] = (list(rel.mnode), list(rel.mway), list(rel.mrelation))
+        self.simplifyRoute(rel)
+        # parse this route and add the edges
+        route_ways = {}
+        self.route2edges(rel, route_ways)
+        self.routeEdges[rel.id] = route_ways.keys()
+        new_ways.update(route_ways)
 
     # substitutes all relation members by its' node and way members
     def simplifyRoute(self, rel, parent=None):
         
-        vprint("simplify rel["+str(rel.id)+"] parent["+( str(parent.id) if
-            parent != None else "")+"]",2);
+        vprint("simplify rel[%s] parent[%s]",2, rel.id, parent.id if parent != None else "")
         for subRelID,role in map(lambda t: (t.items()[0]), rel.mrelation):
-            if 'route' in self.relations[subRelID].tags:
+            #sub relation might be not downloaded or dropped while reading
+            if subRelID in self.relations and \
+                    'route' in self.relations[subRelID].tags:
                 # recursional calls
                 self.simplifyRoute(self.relations[subRelID],rel)
 #TODO delete the simplified relation out of the member list
@@ -441,10 +1747,14 @@ class OSM:
 
 
 
-    def route2edges(self, rel, new_ways, ec):
+    def route2edges(self, rel, new_ways):
         # error counter
         global errors
         route_type = rel.tags['route']
+        # the edges are always oneway (one relation for each direction)
+        edge_tags = self.tagTable.intern(dict(rel.tags, highway=route_type, oneway="yes"))
+        # the k-th edge is named special-<relation id>-<k>
+        ec = 0
         vprint( route_type,2)
 
         #extract stops
@@ -453,7 +1763,7 @@ class OSM:
         for nid,role in map(lambda t: t.items()[0], rel.mnode): 
             if role.split(':')[0]=='stop':
                 stops.append(nid)
-        vprint( str(len(stops))+" Stops found",2)
+        vprint( "%d Stops found",2, len(stops))
 
         tw = None
         # to turn the ways in the right direction
@@ -464,7 +1774,11 @@ class OSM:
         for old_wayid,role in map(lambda t: (t.items()[0]), rel.mway):
             if not (role=='forward' or role=='backward' or role==''):
                 continue
-            vprint( "\ntry adding Way["+str(old_wayid)+"]",2)
+            vprint( "\ntry adding Way[%s]",2, old_wayid)
+            if old_wayid not in self.vways:
+                errors += 1
+                vprint( "ERROR %d: Relation [%s] member Way [%s] is not in the data",0, errors, rel.id, old_wayid)
+                continue
             vprint(self.vways[old_wayid],3)
             nds = []
             
@@ -485,7 +1799,8 @@ class OSM:
                     errors += 1
                     #idea to skip a route if an error was found
                     #TODO add this information to the check-report
-                    vprint( "ERROR "+str(errors)+": Relation ["+str(rel.id)+"] in Way ["+str(old_wayid)+"] is not connected to the previous Way ["+str(last_way)+"]",0)
+                    vprint( "ERROR %d: Relation [%s] in Way [%s] is not connected to the previous Way [%s]",0,
+                            errors, rel.id, old_wayid, last_way)
             else:
                 invert = False
 
@@ -511,65 +1826,362 @@ class OSM:
                 #skip if last stop was already reached
                 if i>=len(stops):
                     break
-                vprint( "waypart ["+str(wayid)+"] info: stop:"+str(i)+\
-                        "["+stops[i]+"] \tn0: "+str(nds[0])+
-                        "\tn-1:"+str(nds[-1]),2)
+                vprint( "waypart [%s] info: stop:%d[%s] \tn0: %s\tn-1:%s",2,
+                        wayid, i, stops[i], nds[0], nds[-1])
                 #there are 2 different edges possible in kinds of stop position 0-x, 1-x
                 #and it might be a continuing or the first edge
                 if tw==None:
                     if stops[i]==nds[0]:
                         #its a new edge
-                        tw = Way('special-'+str(ec),None) 
-                        tw.tags = rel.tags;
-                        tw.tags['highway']=route_type
-                        tw.tags['oneway']="yes"#always oneway (one relation for each direction)
+                        tw = Way('special-%s-%d' % (rel.id, ec),None) 
+                        tw.tags = edge_tags
                         tw.nds.extend(nds) #all nodes have to belong to the edge cause way was split on stops
 
                         i += 1#jump to next stop_position
-                        vprint( "create new Edge ["+str(tw.id)+"]",3)
+                        vprint( "create new Edge [%s]",3, tw.id)
                 else:
                     if stops[i]==nds[0]:
                         #stop the last edge 
                         new_ways[tw.id] = tw
-                        vprint("new wayid="+str(tw.id),3)
+                        vprint("new wayid=%s",3, tw.id)
                         ec += 1
 
-                        vprint( "finish edge ["+tw.id+"] and create new"+\
-                                "Edge [special-"+str(ec)+"]",3)
+                        vprint( "finish edge [%s] and create newEdge [special-%s-%d]",3, tw.id, rel.id, ec)
                         #and start a new one
-                        tw = Way('special-'+str(ec),None) 
-                        tw.tags = rel.tags;
-                        tw.tags['highway']= route_type
-                        tw.tags['oneway']="yes"#always oneway (one relation for each direction)
+                        tw = Way('special-%s-%d' % (rel.id, ec),None) 
+                        tw.tags = edge_tags
                         tw.nds.extend(nds) #all nodes have to belong to the edge cause way was split on stops
 
                         i += 1#jump to next stop_position
                     else:
                         #just continue the last edge
                         tw.nds.extend(nds)
-                        vprint( "continue Edge ["+str(tw.id)+"]",3)
-
-        return ec
+                        vprint( "continue Edge [%s]",3, tw.id)
                         
 
 
 
+    def transferPoints(self):
+        """ returns the stop positions and platforms which are in the node
+            table and the stop areas as lists of them """
+        points = set()
+        for id, tags in self.nodes.tags.iteritems():
+            if isStop(tags) or isPlatform(tags):
+                points.add(str(id))
+        areas = []
+        for rel in self.relations.itervalues():
+            if isStopArea(rel.tags):
+                area = set(nid for m in rel.mnode for nid in m.iterkeys())
+                areas.append(sorted(area, key=int))
+                points.update(area)
+        for mnode, mway, mrelation in self.routeMembers.itervalues():
+            for m in mnode:
+                for nid, role in m.iteritems():
+                    if role.split(':')[0] in ('stop', 'platform'):
+                        points.add(nid)
+        ids = np.unique(np.fromiter((int(nid) for nid in points), np.int64, len(points)))
+        self.nodes.freeze()
+        points = [str(id) for id in ids[np.in1d(ids, self.nodes.ids)].tolist()]
+        known = set(points)
+        areas = [[nid for nid in area if nid in known] for area in areas]
+        return points, areas
+
+    def addTransfers(self):
+        """ adds walking edges between the stops and platforms of one stop area,
+            between all stops and platforms closer than TRANSFER_DISTANCE and
+            from each of them to the nearest street vertex in this distance
+            the edges are named transfer-<node id>-<node id>
+            returns the ids of the new edges """
+        points, areas = self.transferPoints()
+        pairs = set()
+        for area in areas:
+            pairs.update(itertools.combinations(area, 2))
+
+        # street vertexes - the PT edges and transfers are no streets
+        ends = set(nid for way in self.ways.itervalues() if 'highway' in way.tags and
+                way.tags['highway'] not in ('bus', 'tram') and not isTransfer(way.tags)
+                and len(way.nds) > 1 for nid in (way.nds[0], way.nds[-1]))
+        streets = np.sort(np.fromiter((int(nid) for nid in ends), np.int64, len(ends)))
+
+        if points:
+            ids = np.array([int(nid) for nid in points], dtype=np.int64)
+            px, py = self.nodes.project(ids)
+            i, j, dist = gridPairs(px, py, px, py, TRANSFER_DISTANCE)
+            near = ids[i] < ids[j]
+            pairs.update((points[a], points[b]) for a, b in
+                    itertools.izip(i[near].tolist(), j[near].tolist()))
+
+            # the nearest street vertex (the smaller id if two are as near)
+            # of the points which are no street vertex themselves
+            sx, sy = self.nodes.project(streets)
+            i, j, dist = gridPairs(px, py, sx, sy, TRANSFER_DISTANCE)
+            order = np.lexsort((streets[j], dist, i))
+            i, j = i[order], j[order]
+            first = np.ones(len(i), dtype=bool)
+            first[1:] = i[1:] != i[:-1]
+            first &= ~np.in1d(ids[i], streets)
+            pairs.update((points[a], str(b)) for a, b in
+                    itertools.izip(i[first].tolist(), streets[j[first]].tolist()))
+
+        tags = self.tagTable.intern(TRANSFER_TAGS)
+        new_ways = {}
+        for a, b in pairs:
+            if int(b) < int(a):
+                a, b = b, a
+            way = Way('transfer-%s-%s' % (a, b), None)
+            way.tags = tags
+            way.nds = [a, b]
+            new_ways[way.id] = way
+        self.transferEdges = sorted(new_ways)
+        self.ways.update(new_ways)
+        vprint( "%d transfers between %d stops and platforms",2, len(new_ways), len(points))
+        return self.transferEdges
+
+    def originalNodes(self, wid):
+        """ returns the node list of an OSM way out of its split parts """
+        parts = self.vways[wid]
+        nds = list(self.ways[parts[0]].nds)
+        for pid in parts[1:]:
+            nds.extend(self.ways[pid].nds[1:])
+        return nds
+
+    def indexWays(self):
+        """ builds the reverse indexes of update: node -> OSM ways using it
+            (once per use, the outsideWays too) and OSM way -> PT routes
+            using it """
+        vprint( "indexing ways for updates...",2)
+        self.nodeWays = {}
+        for wid in self.vways:
+            for nid in self.originalNodes(wid):
+                self.nodeWays.setdefault(nid, []).append(wid)
+        for wid, nds in self.outsideWays.iteritems():
+            for nid in nds:
+                self.nodeWays.setdefault(nid, []).append(wid)
+        self.wayRoutes = {}
+        for rid in self.routeEdges:
+            self.indexRoute(self.relations[rid])
+
+    def indexRoute(self, rel):
+        for m in rel.mway:
+            for wid in m.iterkeys():
+                self.wayRoutes.setdefault(wid, set()).add(rel.id)
+
+    def update(self, filename):
+        """ applies an osmChange file (.osc or .osc.gz) to the built graph
+            only the changed ways, the ways which are split differently now
+            and the route relations using them are built again
+            with streaming the ways of the diff are filtered as while reading
+            and new ways can only use nodes which are already kept or in the
+            diff """
+        global errors
+        vprint( "update with '"+filename+"'",1)
+        if self.nodeWays is None:
+            self.indexWays()
+        pt = self.transport != "hw"
+
+        changes = {'node':{}, 'way':{}, 'relation':{}}
+        def onChange(action, kind, elem):
+            elem.osm = self
+            elem.tags = self.tagTable.intern(elem.tags)
+            changes[kind][elem.id] = (action, elem)
+        if filename.endswith('.gz'):
+            xml.sax.parse(gzip.open(filename), ChangeHandler(self, onChange, self.keep))
+        else:
+            xml.sax.parse(filename, ChangeHandler(self, onChange, self.keep))
+        nodes, ways, relations = changes['node'], changes['way'], changes['relation']
+
+        def weight(nid):
+            # stop positions always split as in dividerNodes
+            tags = self.nodes.tags.get(int(nid))
+            return 2 if pt and tags and isStop(tags) else 1
+        def divides(nid):
+            return len(self.nodeWays.get(nid, ())) * weight(nid) > 1
+
+        # the nodes which might split ways differently and how they did
+        touched = set(nodes)
+        old_nds = {}
+        for wid, (action, way) in ways.iteritems():
+            if wid in self.vways:
+                old_nds[wid] = self.originalNodes(wid)
+                touched.update(old_nds[wid])
+            elif wid in self.outsideWays:
+                old_nds[wid] = self.outsideWays.pop(wid)
+                touched.update(old_nds[wid])
+            touched.update(way.nds)
+        before = dict((nid, divides(nid)) for nid in touched)
+
+        # nodes
+        self.nodes.update([n for action, n in nodes.itervalues() if action != 'delete'])
+        deleted = [nid for nid, (action, n) in nodes.iteritems() if action == 'delete']
+
+        # ways - first their node uses
+        members = set()
+        for action, rel in relations.itervalues():
+            if 'route' not in rel.tags:
+                continue
+            for m in rel.mway:
+                members.update(m.iterkeys())
+        new_nds = {}
+        for wid, (action, way) in ways.iteritems():
+            for nid in old_nds.get(wid, ()):
+                self.nodeWays[nid].remove(wid)
+            if action == 'delete' or len(way.nds) < 2:
+                continue
+            if self.keep is not None and not isNetworkWay(way):
+                continue
+            if self.streaming and not ((self.transport != "pt" and 'highway' in way.tags)
+                    or wid in self.wayRoutes or wid in members):
+                if self.keep is None:
+                    self.addOutsideWay(way, self.nodes)
+                    for nid in self.outsideWays.get(wid, ()):
+                        self.nodeWays.setdefault(nid, []).append(wid)
+                continue
+            missing = [nid for nid in way.nds if nid not in self.nodes]
+            if missing:
+                errors += 1
+                vprint( "ERROR %d: Way [%s] uses the unknown node [%s]",0, errors, wid, missing[0])
+                continue
+            new_nds[wid] = way.nds
+            for nid in way.nds:
+                self.nodeWays.setdefault(nid, []).append(wid)
+
+        # all ways which have to be split again
+        affected = set(ways)
+        for nid in touched:
+            if nid in nodes or before.get(nid, False) != divides(nid):
+                affected.update(self.nodeWays.get(nid, ()))
+
+        new_ids = []
+        for wid in affected:
+            if wid in ways:
+                way = ways[wid][1]
+                if wid not in new_nds:
+                    way = None
+            elif wid not in self.vways:
+                continue # a way off the network
+            else:
+                way = copy.copy(self.ways[self.vways[wid][0]])
+                way.id = wid
+                way.nds = self.originalNodes(wid)
+            for pid in self.vways.pop(wid, ()):
+                del self.ways[pid]
+            if way is None:
+                continue
+            dividers = set(nid for nid in way.nds if len(self.nodeWays[nid]) * weight(nid) > 1)
+            parts = way.split(dividers)
+            self.vways[wid] = []
+            for part in parts:
+                self.ways[part.id] = part
+                self.vways[wid].append(part.id)
+                new_ids.append(part.id)
+
+        # route relations using the split ways, the changed ones and their
+        # parents
+        routes = set(relations)
+        for wid in affected:
+            routes.update(self.wayRoutes.get(wid, ()))
+        for rid, (mnode, mway, mrelation) in self.routeMembers.iteritems():
+            for m in mrelation:
+                if any(r in relations for r in m.iterkeys()):
+                    routes.add(rid)
+
+        for rid in routes:
+            for pid in self.routeEdges.pop(rid, ()):
+                del self.ways[pid]
+            rel = self.relations.get(rid)
+            if rel is not None and rid in self.routeMembers:
+                for m in rel.mway:
+                    for wid in m.iterkeys():
+                        self.wayRoutes.get(wid, set()).discard(rid)
+                rel.mnode, rel.mway, rel.mrelation = [list(m) for m in self.routeMembers.pop(rid)]
+            if rid in relations:
+                action, rel = relations[rid]
+                if action == 'delete' or (self.streaming or self.keep is not None) \
+                        and not isNetworkRelation(rel):
+                    self.relations.pop(rid, None)
+                    continue
+                self.relations[rid] = rel
+            if rel is None or not pt or not isPublicTransportRoute(rel):
+                continue
+            route_ways = {}
+            self.addRoute(rel, route_ways)
+            self.ways.update(route_ways)
+            new_ids.extend(route_ways.iterkeys())
+            self.indexRoute(rel)
+
+        # nodes are only dropped if no way uses them anymore
+        unused = [nid for nid in deleted if not self.nodeWays.get(nid) and nid in self.nodes]
+        for nid in unused:
+            self.nodeWays.pop(nid, None)
+        if unused:
+            self.nodes.remove(unused)
+
+        # the transfers are cheap enough to be built again as a whole
+        if pt:
+            for wid in self.transferEdges:
+                del self.ways[wid]
+            new_ids.extend(self.addTransfers())
+
+        self.computeLengths([self.ways[i] for i in new_ids])
+        vprint( "%d nodes, %d ways, %d relations changed: %d ways split again, %d routes rebuilt",1,
+                len(nodes), len(ways), len(relations), len(affected), len(routes))
+
+    def computeLengths(self, ways=None):
+        """ calculates the length in km of all ways (or the given ones) in one
+            vectorized pass over the node coordinates and stores it in
+            way.length
+        """
+        if ways is None:
+            ways = self.ways.values()
+        ways = [w for w in ways if len(w.nds) > 0]
+        if not ways:
+            return
+        counts = np.fromiter((len(w.nds) for w in ways), np.int64, len(ways))
+        idx = self.nodes.indices(itertools.chain.from_iterable(w.nds for w in ways),
+                int(counts.sum()))
+        lat = self.nodes.lat[idx]
+        lon = self.nodes.lon[idx]
+
+        # same haversine formula as calclength - segment i goes from node i
+        # to node i+1
+        R = 6371 # km
+        dLat = (lat[:-1] - lat[1:]) * math.pi / 180
+        dLon = (lon[:-1] - lon[1:]) * math.pi / 180
+        lat1 = lat[1:] * math.pi / 180
+        lat2 = lat[:-1] * math.pi / 180
+        a = np.sin(dLat/2) * np.sin(dLat/2) + np.sin(dLon/2) * np.sin(dLon/2) * np.cos(lat1) * np.cos(lat2)
+        c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+        seg = np.zeros(len(lat))
+        seg[:-1] = R * c
+
+        # drop the segments between the last node of a way and the first of
+        # the next one and sum up per way
+        starts = np.cumsum(counts) - counts
+        seg[starts[1:]-1] = 0
+        lengths = np.add.reduceat(seg, starts)
+        for way, length in itertools.izip(ways, lengths):
+            way.length = float(length)
+
     #calculates the way length in km
     # needs access to the nodes list - therefore its here
+    # uses the cached value of computeLengths if there is one
     def calclength(self,way):
+        if way.length is not None:
+            return way.length
         lastnode = None
         length = 0
-        for node in way.nds:
+        for nid in way.nds:
+            node = self.nodes[nid]
             if lastnode is None:
-                lastnode = self.nodes[node]
+                lastnode = node
                 continue
 
             # copied from
             # http://stackoverflow.com/questions/5260423/torad-javascript-function-throwing-error
             R = 6371 # km
-            dLat = (lastnode.lat - self.nodes[node].lat) * math.pi / 180
-            dLon = (lastnode.lon - self.nodes[node].lon) * math.pi / 180
-            lat1 = self.nodes[node].lat * math.pi / 180
+            dLat = (lastnode.lat - node.lat) * math.pi / 180
+            dLon = (lastnode.lon - node.lon) * math.pi / 180
+            lat1 = node.lat * math.pi / 180
             lat2 = lastnode.lat * math.pi / 180
             a = math.sin(dLat/2) * math.sin(dLat/2) + math.sin(dLon/2) * math.sin(dLon/2) * math.cos(lat1) * math.cos(lat2)
             c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
@@ -577,10 +2189,99 @@ class OSM:
 
             length += d
 
-            lastnode = self.nodes[node]
+            lastnode = node
 
         return length
 
+    def isChainWay(self, way):
+        """ ways which may be merged by contractChains - the PT edges and the
+            transfers are left as they are """
+        return 'highway' in way.tags and len(way.nds) > 1 and \
+                way.tags['highway'] not in ('bus', 'tram') and not isTransfer(way.tags)
+
+    def graphSize(self):
+        """ returns the number of (vertexes, edges) of the highways """
+        vertexes = set()
+        edges = 0
+        for way in self.ways.itervalues():
+            if 'highway' in way.tags and len(way.nds) > 1:
+                vertexes.add(way.nds[0])
+                vertexes.add(way.nds[-1])
+                edges += 1
+        return len(vertexes), edges
+
+    def contractChains(self):
+        """ merges ways with the same CHAIN_TAGS which meet at a node nothing
+            else uses into one way with the whole geometry and the summed
+            length - the merged way keeps id and tags of its first part
+            stop positions and nodes of relations are never removed
+        """
+        vprint( "contract chains...",1)
+        before = self.graphSize()
+
+        # how often each node is used at all and as end of a chain way
+        uses = {}
+        ends = {}
+        for way in self.ways.itervalues():
+            for nid in way.nds:
+                uses[nid] = uses.get(nid, 0) + 1
+            if self.isChainWay(way):
+                for nid in (way.nds[0], way.nds[-1]):
+                    ends.setdefault(nid, []).append(way.id)
+        keep = self.stopNodes()
+        for rel in self.relations.itervalues():
+            for member in rel.mnode:
+                keep.update(member.iterkeys())
+
+        merged = {} # removed way id: way id it was merged into
+        def current(wid):
+            while wid in merged:
+                wid = merged[wid]
+            return wid
+
+        for nid, wids in ends.iteritems():
+            if len(wids) != 2 or uses[nid] != 2 or nid in keep:
+                continue
+            a = self.ways[current(wids[0])]
+            b = self.ways[current(wids[1])]
+            if a is b:# a ring
+                continue
+            key = [a.tags.get(k) for k in CHAIN_TAGS]
+            if key != [b.tags.get(k) for k in CHAIN_TAGS]:
+                continue
+            # a has to end and b to start at nid - oneways are never turned
+            if a.nds[-1] != nid:
+                a, b = b, a
+            anodes = a.nds
+            bnodes = b.nds
+            if anodes[-1] != nid or bnodes[0] != nid:
+                if onewayDirection(a.tags) != 0:
+                    continue
+                # reversed copies - the stored ways are left as they are
+                if anodes[-1] != nid:
+                    anodes = anodes[::-1]
+                if bnodes[0] != nid:
+                    bnodes = bnodes[::-1]
+            way = copy.copy(a)
+            way.nds = anodes + bnodes[1:]
+            way.length = self.calclength(a) + self.calclength(b)
+            self.ways[a.id] = way
+            del self.ways[b.id]
+            merged[b.id] = a.id
+
+        # the split parts of the original ways now point to the merged ones
+        for old_id, parts in self.vways.iteritems():
+            new_parts = []
+            for wid in parts:
+                wid = current(wid)
+                if not new_parts or new_parts[-1] != wid:
+                    new_parts.append(wid)
+            self.vways[old_id] = new_parts
+
+        after = self.graphSize()
+        vprint( "vertexes: %d -> %d, edges: %d -> %d (%d ways merged)",1,
+                before[0], after[0], before[1], after[1], len(merged))
+
     # TODO rewrite to export to cvs
     # convert2mat
     #
@@ -605,20 +2306,8 @@ class OSM:
 
                 self.length = length
 
-                hw={'footway':1, 'cycleway':2, 'path':1, 'residental':4,'motorway':3,'trunk':3,'motorway_link':3,'primary':3,
-                        'secondary':3, 'tertiary':4, 'living_street':4, 'unclassified':4, 'service':4, 'track':2, 'steps':1,
-                        'bus':5, 'tram':6}
-                if "highway" in tags and tags["highway"] in hw:
-                    self.highway = hw[tags["highway"]]
-                else:
-                    self.highway = 1# if unknown its a footway
-
-                self.access_foot = 1
-                if "foot" in tags and tags["foot"] == "no":
-                    self.access_foot = 0
-                self.access_bike = 1
-                if "bicycle" in tags and tags["bicycle"] == "no":
-                    self.access_bike = 0
+                self.highway = highwayClass(tags)
+                self.access_foot, self.access_bike = access(tags)
 
             def toString(self):
                 return "" + str(self.dest) + ", '" + self.name.replace("'", "''") + "', " + str(self.length) + ", " + str(self.highway) + ", " + str(self.access_foot) + ", " + str(self.access_bike) + ";"
@@ -659,14 +2348,14 @@ class OSM:
             # add edge with way direction
             eid += 1
             edges.append(Edge(eid, way.id, way.nds, way.tags, self.calclength(way)))
-            vprint( "eID: " + str(eid) + "\tdest: " + str(way.nds[-1]) + "\torg:" + str(way.nds[0]),3)
+            vprint( "eID: %d\tdest: %s\torg:%s",3, eid, way.nds[-1], way.nds[0])
 
             if way.nds[0] in node_lu:
-                vprint( "org: "+ str(way.nds[0]) + "new: " + str(node_lu[way.nds[0]]),3)
+                vprint( "org: %snew: %s",3, way.nds[0], node_lu[way.nds[0]])
                 vertexes[node_lu[way.nds[0]]-1].add_edge(eid)
             else:
                 node = self.nodes[way.nds[0]]
-                vprint( "add new id: " + str(node.id) + "=>" + str(nid),3)
+                vprint( "add new id: %s=>%d",3, node.id, nid)
                 node_lu[str(node.id)] = nid # substitute the node id with array index
                 vertexes.append(Vertex(node.id, node.lon, node.lon, [], node.tags))
                 vertexes[nid-1].add_edge(eid)
@@ -678,11 +2367,11 @@ class OSM:
             edges.append(Edge(eid, way.id, reversed_nodes, way.tags, self.calclength(way)))
 
             if reversed_nodes[0] in node_lu:
-                vprint( "org: "+ str(way.nds[0]) + "new: " + str(node_lu[way.nds[0]]),3)
+                vprint( "org: %snew: %s",3, way.nds[0], node_lu[way.nds[0]])
                 vertexes[node_lu[reversed_nodes[0]]-1].add_edge(eid)
             else:
                 node = self.nodes[reversed_nodes[0]]
-                vprint( "add new id: " + str(node.id) + "=>" + str(nid),3)
+                vprint( "add new id: %s=>%d",3, node.id, nid)
                 node_lu[node.id] = nid # substitute the node id with array index
                 vertexes.append(Vertex(node.id, node.lon, node.lon, [], node.tags))
                 vertexes[nid-1].add_edge(eid)
@@ -700,8 +2389,9 @@ class OSM:
         f.write("edges = {\n")
         for ed in edges:
             i += 1
-            vprint( str(i) + ": " + ed.toString(),3)
-            f.write( ed.toString()+"\n")
+            line = ed.toString()
+            vprint( "%d: %s",3, i, line)
+            f.write( line+"\n")
         f.write( "};\n\n")
 
         i = 0
@@ -709,25 +2399,41 @@ class OSM:
         f.write( "nodes = {\n")
         for v in vertexes:
           i+=1
-          vprint( str(i)+": "+ v.toString(),3)
-          f.write( v.toString() +"\n")
+          line = v.toString()
+          vprint( "%d: %s",3, i, line)
+          f.write( line +"\n")
         f.write( "};\n\n")
         f.write("save('graph.mat','edges','nodes','-mat');")
         f.close()
         vprint( "run 'octave "+filename+"' to generate graph.mat to load in your program",2)
 
     # exports to osm xml
-    def export(self,filename,transport):
+    # the document is written in chunks through a buffer and is gzipped on
+    # the fly if compress is set or the filename ends with .gz
+    def export(self,filename,transport,compress=False):
         vprint( "osm-xml export...",1)
 
-        #remember all nodes already exported
-        unodes = {}
+        if compress or filename.endswith('.gz'):
+            fp = gzip.open(filename, "wb")
+        else:
+            fp = open(filename, "wb")
 
-        fp = open(filename, "w")
-        x = XMLGenerator(fp, "UTF-8")
-        x.startDocument()
-        x.startElement('osm',{"version":"0.6","generator":"crazy py script"})
+        buf = []
+        def flush():
+            fp.write(u"".join(buf).encode('utf-8'))
+            del buf[:]
+
+        def tags2xml(tags):
+            for k, v in tags.iteritems():
+                buf.append(u'  <tag k=%s v=%s/>\n' % (quoteattr(k), quoteattr(v)))
 
+        #remember all nodes already exported
+        unodes = set()
+        store = self.nodes
+
+        buf.append(u'<?xml version="1.0" encoding="UTF-8"?>\n')
+        buf.append(u'<osm version="0.6" generator="crazy py script">\n')
+        wc = 0 # the ways are numbered as written
         for w in self.ways.itervalues():
             if not 'highway' in w.tags:
                 continue
@@ -737,20 +2443,301 @@ class OSM:
             if transport == "all" or transport == "hw":
                 if (w.tags['highway']=='bus' or w.tags['highway']=='tram'):
                     continue
-            w.toOSM(x)
+            wc += 1
+            buf.append(u' <way id="-%d">\n' % wc)
             for nid in w.nds:
+                buf.append(u'  <nd ref=%s/>\n' % quoteattr(nid))
+            tags2xml(w.tags)
+            buf.append(u' </way>\n')
+
+            idx = store.indices(w.nds, len(w.nds))
+            last = len(w.nds)-1
+            for i, nid in enumerate(w.nds):
                 if nid in unodes:#already used
                     continue
-                unodes[nid]=True
-                if w.nds.index(nid)==0 or w.nds.index(nid)==len(w.nds)-1:
-                    self.nodes[nid].toOSM(x,True)
+                unodes.add(nid)
+                j = idx[i]
+                tags = store.tags.get(int(store.ids[j]))
+                buf.append(u' <node id=%s lat="%s" lon="%s" visible="true"' %
+                        (quoteattr(nid), str(float(store.lat[j])), str(float(store.lon[j]))))
+                #the first and the last node of a way are graph vertexes
+                if i==0 or i==last or tags:
+                    buf.append(u'>\n')
+                    if i==0 or i==last:
+                        buf.append(u'  <tag k="routing_crossing" v="yes"/>\n')
+                    if tags:
+                        tags2xml(tags)
+                    buf.append(u' </node>\n')
                 else:
-                    self.nodes[nid].toOSM(x)
-        x.endElement('osm')
-        x.endDocument()
+                    buf.append(u'/>\n')
+            if len(buf) > 65536:
+                flush()
+        buf.append(u'</osm>\n')
+        flush()
+        fp.close()
+
+    def exportColumns(self, filename):
+        """ streams the directed routing graph (as toCSR) in chunks of ways to
+            column files, see ColumnWriter. The vertexes are numbered from 0
+            in the order they are reached, so only the vertex numbers of the
+            nodes are kept in memory """
+        vprint( "column export to '"+filename+"'",1)
+        store = self.nodes
+        vertex = np.empty(store.count, dtype=np.int32)
+        vertex.fill(-1)
+        vertexes = 0
+        names = []
+        name_index = {}
+        def nameIndex(tags):
+            if "name" not in tags:
+                return -1
+            i = name_index.get(tags["name"])
+            if i is None:
+                i = name_index[tags["name"]] = len(names)
+                names.append(tags["name"])
+            return i
+
+        # the tags are shared, so their properties are computed once
+        properties = {}
+        def edgeProperties(tags):
+            p = properties.get(tags)
+            if p is None:
+                f, b = access(tags)
+                p = properties[tags] = (onewayDirection(tags), highwayClass(tags), f, b, nameIndex(tags))
+            return p
+
+        writer = ColumnWriter(filename)
+        ways = (w for w in self.ways.itervalues() if 'highway' in w.tags)
+        while True:
+            chunk = list(itertools.islice(ways, EXPORT_CHUNK))
+            if not chunk:
+                break
+            n = len(chunk)
+            ends = np.empty((n, 2), dtype=np.int64)
+            ends[:,0] = store.indices((w.nds[0] for w in chunk), n)
+            ends[:,1] = store.indices((w.nds[-1] for w in chunk), n)
+            direction, highway, foot, bike, name = np.array(
+                    [edgeProperties(w.tags) for w in chunk], dtype=np.int64).T
+            length = np.fromiter((self.calclength(w) for w in chunk), np.float64, n)
+            # the osm way of a part or the relation of a PT edge
+            osm_id = np.fromiter((osmId(w.id) for w in chunk),
+                    np.int64, n)
+
+            # new vertexes in the order they are reached
+            seq = ends.ravel()
+            seq = seq[vertex[seq] < 0]
+            first, index = np.unique(seq, return_index=True)
+            new = first[np.argsort(index)]
+            vertex[new] = np.arange(vertexes, vertexes + len(new))
+            vertexes += len(new)
+            ids = store.ids[new]
+            tags = store.tags
+            writer.write('nodes', [ids, store.lon[new], store.lat[new],
+                    [nameIndex(tags[i]) if i in tags else -1 for i in ids.tolist()]],
+                    names)
+
+            # along the way unless it is oneway against it and the other way
+            # round unless it is oneway
+            keep = np.empty((n, 2), dtype=bool)
+            keep[:,0] = direction != -1
+            keep[:,1] = direction != 1
+            keep = keep.ravel()
+            src = vertex[ends.ravel()][keep]
+            dst = vertex[ends[:,::-1].ravel()][keep]
+            writer.write('edges', [src, dst] + [np.repeat(c, 2)[keep]
+                    for c in (length, highway, foot, bike, osm_id, name)], names)
+        writer.close(names)
+        vprint( "%d vertexes written",2, vertexes)
+
+    def toCSR(self):
+        """ returns the directed routing graph (oneway respected) as CSRGraph
+            the vertexes are the end nodes of all highways """
+        src = []
+        dst = []
+        lengths = []
+        highway = []
+        foot = []
+        bike = []
+        for way in self.ways.itervalues():
+            if 'highway' not in way.tags:
+                continue
+            direction = onewayDirection(way.tags)
+            length = self.calclength(way)
+            hw = highwayClass(way.tags)
+            f, b = access(way.tags)
+            for a, z in ((way.nds[0], way.nds[-1]), (way.nds[-1], way.nds[0])):
+                if direction == 1 and a != way.nds[0] or \
+                        direction == -1 and a == way.nds[0]:
+                    continue
+                src.append(a)
+                dst.append(z)
+                lengths.append(length)
+                highway.append(hw)
+                foot.append(f)
+                bike.append(b)
+        return CSRGraph.fromEdges(self.nodes, src, dst, lengths, highway, foot, bike)
+
+    def exportSQLite(self, filename):
+        """ writes the vertexes, the edges with their geometry and the PT
+            routes to a new SQLite database, see SQLITE_SCHEMA
+            the rows are inserted in chunks in one transaction, the indexes
+            are built after the load """
+        vprint( "SQLite export to '"+filename+"'",1)
+        if os.path.exists(filename):
+            os.remove(filename)
+        db = sqlite3.connect(filename)
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        db.executescript(SQLITE_SCHEMA)
+        store = self.nodes
+        vertex = np.zeros(store.count, dtype=bool)
+        edges = 0
+
+        ways = (w for w in self.ways.itervalues() if 'highway' in w.tags)
+        while True:
+            chunk = list(itertools.islice(ways, EXPORT_CHUNK))
+            if not chunk:
+                break
+            counts = np.fromiter((len(w.nds) for w in chunk), np.int64, len(chunk))
+            idx = store.indices((nid for w in chunk for nid in w.nds), counts.sum())
+            starts = np.cumsum(counts) - counts
+            ends = np.cumsum(counts) - 1
+            lon = store.lon[idx]
+            lat = store.lat[idx]
+            coords = np.column_stack([lon, lat]).astype('<f8')
+
+            # new vertexes
+            new = np.unique(idx[np.concatenate([starts, ends])])
+            new = new[~vertex[new]]
+            vertex[new] = True
+            tags = store.tags
+            db.executemany("INSERT INTO nodes VALUES (?,?,?,?)",
+                    ((nid, la, lo, tags[nid].get("name") if nid in tags else None)
+                    for nid, la, lo in itertools.izip(store.ids[new].tolist(),
+                    store.lat[new].tolist(), store.lon[new].tolist())))
+
+            def rows():
+                for i, w in enumerate(chunk):
+                    a, b = starts[i], ends[i]
+                    f, bk = access(w.tags)
+                    yield (edges + i + 1, w.id, osmId(w.id),
+                            w.nds[0], w.nds[-1], onewayDirection(w.tags), self.calclength(w),
+                            highwayClass(w.tags), f, bk, w.tags.get("name"),
+                            buffer(coords[a:b+1].tostring()))
+            db.executemany("INSERT INTO edges VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", rows())
+            db.executemany("INSERT INTO temp.boxes VALUES (?,?,?,?,?)", itertools.izip(
+                    xrange(edges + 1, edges + len(chunk) + 1),
+                    np.minimum.reduceat(lon, starts).tolist(), np.maximum.reduceat(lon, starts).tolist(),
+                    np.minimum.reduceat(lat, starts).tolist(), np.maximum.reduceat(lat, starts).tolist()))
+            edges += len(chunk)
+
+        # PT routes with their members and their edges in order
+        edge_ids = dict(db.execute("SELECT way, id FROM edges WHERE way LIKE 'special-%'"))
+        for rid, (mnode, mway, mrelation) in self.routeMembers.iteritems():
+            rel = self.relations.get(rid)
+            if rel is None:
+                continue
+            db.execute("INSERT INTO routes VALUES (?,?,?,?)", (int(rid), rel.tags.get('route'),
+                    rel.tags.get('ref'), rel.tags.get('name')))
+            members = [(kind, m) for kind, ms in (('node', mnode), ('way', mway), ('relation', mrelation))
+                    for m in ms]
+            db.executemany("INSERT INTO route_members VALUES (?,?,?,?,?)",
+                    ((int(rid), seq, kind, int(ref), role) for seq, (kind, m) in enumerate(members)
+                    for ref, role in m.iteritems()))
+            parts = sorted((int(pid.rsplit("-",1)[1]), pid) for pid in self.routeEdges.get(rid, ()))
+            db.executemany("INSERT INTO route_edges VALUES (?,?,?)",
+                    ((int(rid), seq, edge_ids[pid]) for seq, pid in parts if pid in edge_ids))
+        db.commit()
+
+        vprint( "building the indexes...",2)
+        db.executescript(SQLITE_INDEXES)
+        try:
+            db.executescript(SQLITE_RTREE)
+        except sqlite3.OperationalError, e:
+            vprint( "no R*Tree in this SQLite ("+str(e)+") - using plain coordinate indexes",0)
+            db.executescript("CREATE INDEX nodes_lat_lon ON nodes (lat, lon);")
+        db.commit()
+        db.close()
+        vprint( "%d vertexes and %d edges written",2, vertex.sum(), edges)
+
+    def toSparse(self, mode=None):
+        """ returns the directed routing graph (oneway respected) as
+            scipy.sparse.csr_matrix of the edge lengths (km) and the osm ids,
+            lat and lon of its rows, see CSRGraph.toSparse """
+        graph = self.toCSR()
+        return graph.toSparse(mode), graph.ids, graph.lat, graph.lon
+
+    def render(self, filename, size=2000):
+        """ draws all highways and PT edges at their coordinates to an image
+            (png, svg or pdf by the extension of filename) whose longer side
+            has size pixels - without a display
+            nodes in the same pixel as the previous node of a way are left
+            out, so big graphs do not draw more lines than the image shows """
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.collections import PathCollection
+        from matplotlib.path import Path
+
+        ways = [w for w in self.ways.itervalues() if 'highway' in w.tags]
+        if not ways:
+            raise ValueError("there are no highways to render")
+        counts = np.fromiter((len(w.nds) for w in ways), np.int64, len(ways))
+        idx = self.nodes.indices((nid for w in ways for nid in w.nds), counts.sum())
+        lat = self.nodes.lat[idx]
+        lon = self.nodes.lon[idx]
+
+        # equirectangular pixels with a margin of 1%, y upwards
+        x = lon * math.cos((lat.min() + lat.max()) / 2 * math.pi / 180)
+        y = lat
+        extent = max(x.max() - x.min(), y.max() - y.min(), 1e-9)
+        scale = (size - 1) * 0.98 / extent
+        x = (x - x.min()) * scale + (size - 1) * 0.01
+        y = (y - y.min()) * scale + (size - 1) * 0.01
+        width = int(x.max() + (size - 1) * 0.01) + 1
+        height = int(y.max() + (size - 1) * 0.01) + 1
+
+        # level of detail - keep the first node of a way, every node in
+        # another pixel than the previous one
+        starts = np.zeros(len(x), dtype=bool)
+        starts[np.cumsum(counts) - counts] = True
+        px = np.rint(x)
+        py = np.rint(y)
+        keep = starts.copy()
+        keep[1:] |= (px[1:] != px[:-1]) | (py[1:] != py[:-1])
+        # and the last one, so the way ends in the right pixel
+        keep[np.cumsum(counts) - 1] = True
+        kept = np.flatnonzero(keep)
+        classes = np.repeat(np.fromiter((highwayClass(w.tags) for w in ways),
+                np.int64, len(ways)), counts)[kept]
+        codes = np.where(starts[kept], Path.MOVETO, Path.LINETO).astype(Path.code_type)
+        points = np.column_stack([x[kept], y[kept]])
+
+        # one path of polylines per highway class, all drawn by one collection
+        paths = []
+        colors = []
+        widths = []
+        for c, color, linewidth in RENDER_STYLE:
+            mask = classes == c
+            if mask.any():
+                paths.append(Path(points[mask], codes[mask]))
+                colors.append(color)
+                widths.append(linewidth)
+
+        fig = Figure(figsize=(width / 100.0, height / 100.0), dpi=100)
+        FigureCanvasAgg(fig)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        ax.add_collection(PathCollection(paths, facecolors='none', edgecolors=colors,
+                linewidths=widths))
+        ax.set_xlim(0, width)
+        ax.set_ylim(0, height)
+        fig.savefig(filename, facecolor='white')
+        vprint( "%d of %d nodes drawn to '%s' (%dx%d)",2,
+                len(kept), len(x), filename, width, height)
 
     # returns a nice graph
     # attention do not use for a bigger network (only single lines)
+    # toSparse is much faster for scipy.sparse.csgraph
     def graph(self,only_roads=True):
       G = networkx.Graph()
 
@@ -793,6 +2780,1095 @@ class OSM:
 #        # Always shut down your
 #        db.shutdown()
 
+# ColumnWriter
+#
+# writes the tables edges and nodes in chunks, the columns are:
+#  edges: source, target (vertex numbers from 0), length (km), highway (class
+#         as in the Matlab export), foot, bike (access 0/1), osm_id (the way
+#         or for bus and tram edges the route relation, 0 for transfers) and
+#         name
+#  nodes: id (osm node id), lon, lat and name
+# FILE.csv is written as FILE_edges.csv and FILE_nodes.csv with the names as
+# text. Else every column is a .npy file (edges_source.npy, ...), the names
+# are indexes into names.npy (-1 for none). FILE.npz is a zip archive of
+# them, any other FILE a directory.
+EXPORT_CHUNK = 65536 # ways per chunk
+EDGE_COLUMNS = [('source', np.int32), ('target', np.int32), ('length', np.float64),
+        ('highway', np.uint8), ('foot', np.uint8), ('bike', np.uint8),
+        ('osm_id', np.int64), ('name', np.int32)]
+NODE_COLUMNS = [('id', np.int64), ('lon', np.float64), ('lat', np.float64),
+        ('name', np.int32)]
+
+class ColumnWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.tables = {'edges': EDGE_COLUMNS, 'nodes': NODE_COLUMNS}
+        base, ext = os.path.splitext(filename)
+        self.csv = ext == '.csv'
+        self.npz = ext == '.npz'
+        self.files = {}
+        if self.csv:
+            for table, columns in self.tables.iteritems():
+                fp = open("%s_%s.csv" % (base, table), 'wb')
+                csv.writer(fp).writerow([c for c, dtype in columns])
+                self.files[table] = fp
+            return
+        if self.npz:
+            self.dir = tempfile.mkdtemp(prefix="osm2graph")
+        else:
+            self.dir = filename
+            if not os.path.isdir(filename):
+                os.makedirs(filename)
+        for table, columns in self.tables.iteritems():
+            self.files[table] = [NpyColumn(os.path.join(self.dir, "%s_%s.npy" % (table, c)), dtype)
+                    for c, dtype in columns]
+
+    def write(self, table, values, names):
+        """ appends rows given as one sequence per column, the name columns
+            are indexes into the list of names """
+        if not self.csv:
+            for column, v in zip(self.files[table], values):
+                column.write(v)
+            return
+        rows = []
+        for (c, dtype), v in zip(self.tables[table], values):
+            v = np.asarray(v).tolist()
+            if c == 'name':
+                v = [names[i].encode('utf-8') if i >= 0 else '' for i in v]
+            rows.append(v)
+        csv.writer(self.files[table]).writerows(itertools.izip(*rows))
+
+    def close(self, names):
+        if self.csv:
+            for fp in self.files.itervalues():
+                fp.close()
+            return
+        for columns in self.files.itervalues():
+            for column in columns:
+                column.close()
+        np.save(os.path.join(self.dir, "names.npy"), np.array(names, dtype=np.unicode_))
+        if self.npz:
+            # stored, not compressed - the columns are copied from disk
+            zf = zipfile.ZipFile(self.filename, 'w', zipfile.ZIP_STORED, allowZip64=True)
+            for name in sorted(os.listdir(self.dir)):
+                zf.write(os.path.join(self.dir, name), name)
+            zf.close()
+            shutil.rmtree(self.dir)
+
+# SQLite export
+#
+# nodes are the vertexes (osm node ids), edges the split ways in both
+# directions unless direction is 1 (only source to target) or -1 (only
+# target to source). geometry holds the lon/lat pairs of all nodes of an edge
+# as little endian doubles. The view arcs lists every usable direction as
+# own row for adjacency queries, nodes_rtree and edges_rtree the bounding
+# boxes for spatial ones.
+SQLITE_SCHEMA = """
+CREATE TABLE nodes (id INTEGER PRIMARY KEY, lat REAL, lon REAL, name TEXT);
+CREATE TABLE edges (id INTEGER PRIMARY KEY, way TEXT, osm_id INTEGER,
+    source INTEGER, target INTEGER, direction INTEGER, length REAL,
+    highway INTEGER, foot INTEGER, bike INTEGER, name TEXT, geometry BLOB);
+CREATE TABLE routes (id INTEGER PRIMARY KEY, route TEXT, ref TEXT, name TEXT);
+CREATE TABLE route_members (route INTEGER, seq INTEGER, type TEXT, ref INTEGER, role TEXT);
+CREATE TABLE route_edges (route INTEGER, seq INTEGER, edge INTEGER);
+CREATE TEMP TABLE boxes (id INTEGER PRIMARY KEY, min_lon REAL, max_lon REAL,
+    min_lat REAL, max_lat REAL);
+CREATE VIEW arcs AS
+    SELECT id AS edge, source, target, length, highway, foot, bike FROM edges
+        WHERE direction >= 0
+    UNION ALL
+    SELECT id AS edge, target AS source, source AS target, length, highway, foot, bike
+        FROM edges WHERE direction <= 0;
+"""
+SQLITE_INDEXES = """
+CREATE INDEX edges_source ON edges (source);
+CREATE INDEX edges_target ON edges (target);
+CREATE INDEX route_members_route ON route_members (route, seq);
+CREATE INDEX route_edges_route ON route_edges (route, seq);
+CREATE INDEX route_edges_edge ON route_edges (edge);
+"""
+SQLITE_RTREE = """
+CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat);
+INSERT INTO nodes_rtree SELECT id, lon, lon, lat, lat FROM nodes;
+CREATE VIRTUAL TABLE edges_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat);
+INSERT INTO edges_rtree SELECT * FROM temp.boxes;
+"""
+
+# NpyColumn
+#
+# a .npy file which is written in chunks, the header gets the length when
+# the file is closed
+class NpyColumn:
+    HEADER = 128 # bytes reserved for the header
+
+    def __init__(self, filename, dtype):
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.fp = open(filename, 'wb')
+        self.fp.write(' ' * self.HEADER)
+
+    def write(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        values.tofile(self.fp)
+        self.count += len(values)
+
+    def close(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+                np.lib.format.dtype_to_descr(self.dtype), self.count)
+        header = header.ljust(self.HEADER - 11) + '\n'
+        self.fp.seek(0)
+        self.fp.write('\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header)
+        self.fp.close()
+
+# CSRGraph
+#
+# directed routing graph in compressed sparse row format: the edges of vertex
+# i are offsets[i] .. offsets[i+1]-1 with the target vertex in targets.
+# Saved as a versioned binary file which is loaded with memory mapping, so
+# several processes share the same pages without parsing anything.
+class CSRGraph:
+    MAGIC = "O2GCSR\0\0"
+    VERSION = 1
+    # array name, type, counted per vertex (v), vertex+1 (o) or edge (e)
+    ARRAYS = [('ids', '<i8', 'v'), ('lat', '<f8', 'v'), ('lon', '<f8', 'v'),
+            ('offsets', '<i8', 'o'), ('targets', '<i4', 'e'), ('lengths', '<f8', 'e'),
+            ('highway', 'u1', 'e'), ('foot', 'u1', 'e'), ('bike', 'u1', 'e')]
+    COUNTS = 've'
+
+    def __init__(self, ids, lat, lon, offsets, targets, lengths, highway, foot, bike):
+        self.ids = ids          # osm node id of each vertex (sorted)
+        self.lat = lat
+        self.lon = lon
+        self.offsets = offsets
+        self.targets = targets
+        self.lengths = lengths  # km
+        self.highway = highway  # see HIGHWAY_CLASSES
+        self.foot = foot
+        self.bike = bike
+
+    @classmethod
+    def fromEdges(cls, nodes, src, dst, lengths, highway, foot, bike):
+        """ builds the graph out of edge lists with osm node ids """
+        src = np.fromiter((int(n) for n in src), np.int64, len(src))
+        dst = np.fromiter((int(n) for n in dst), np.int64, len(dst))
+        ids = np.unique(np.concatenate([src, dst]))
+        idx = nodes.indices(ids, len(ids))
+        src = np.searchsorted(ids, src)
+        order = np.argsort(src, kind='mergesort')
+        offsets = np.zeros(len(ids)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(src, minlength=len(ids)))
+        return cls(ids, nodes.lat[idx], nodes.lon[idx], offsets,
+                np.searchsorted(ids, dst)[order].astype(np.int32),
+                np.asarray(lengths, dtype=np.float64)[order],
+                np.asarray(highway, dtype=np.uint8)[order],
+                np.asarray(foot, dtype=np.uint8)[order],
+                np.asarray(bike, dtype=np.uint8)[order])
+
+    def numVertices(self):
+        return len(self.ids)
+
+    def numEdges(self):
+        return len(self.targets)
+
+    # returns the vertex index of an osm node id
+    def vertexIndex(self, nid):
+        nid = int(nid)
+        i = int(np.searchsorted(self.ids, nid))
+        if i == len(self.ids) or self.ids[i] != nid:
+            raise KeyError(nid)
+        return i
+
+    # returns the vertex next to a coordinate (linear scan over all vertexes)
+    def nearestVertex(self, lat, lon):
+        dx = (np.asarray(self.lon) - lon) * math.cos(lat * math.pi / 180)
+        dy = np.asarray(self.lat) - lat
+        return int(np.argmin(dx*dx + dy*dy))
+
+    def adjacency(self, mode=None):
+        """ returns per vertex lists of (target, length) of all edges usable
+            with mode (None: all edges, 'foot' or 'bike')
+            built once per mode - plain lists are much faster to walk than
+            numpy arrays """
+        if not hasattr(self, '_adjacency'):
+            self._adjacency = {}
+        if mode not in self._adjacency:
+            offsets = self.offsets.tolist()
+            targets = self.targets.tolist()
+            lengths = self.lengths.tolist()
+            if mode == 'foot':
+                usable = self.foot.tolist()
+            elif mode == 'bike':
+                usable = self.bike.tolist()
+            else:
+                usable = None
+            adj = []
+            for v in xrange(len(offsets)-1):
+                edges = range(offsets[v], offsets[v+1])
+                if usable is not None:
+                    edges = [e for e in edges if usable[e]]
+                adj.append([(targets[e], lengths[e]) for e in edges])
+            self._adjacency[mode] = adj
+        return self._adjacency[mode]
+
+    def toSparse(self, mode=None):
+        """ returns the edge lengths (km) between the vertex indexes as
+            scipy.sparse.csr_matrix for scipy.sparse.csgraph, only the edges
+            usable with mode. Of parallel edges the shortest one is kept,
+            lengths of 0 become the smallest float as csgraph takes 0 for
+            no edge """
+        from scipy.sparse import csr_matrix
+        n = self.numVertices()
+        src = np.repeat(np.arange(n, dtype=np.int32), np.diff(self.offsets))
+        dst = np.asarray(self.targets)
+        lengths = np.asarray(self.lengths)
+        if mode == 'foot':
+            usable = np.asarray(self.foot) != 0
+        elif mode == 'bike':
+            usable = np.asarray(self.bike) != 0
+        else:
+            usable = slice(None)
+        src, dst, lengths = src[usable], dst[usable], lengths[usable]
+
+        order = np.lexsort((lengths, dst, src))
+        src, dst, lengths = src[order], dst[order], lengths[order]
+        first = np.ones(len(src), dtype=bool)
+        first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+        src, dst, lengths = src[first], dst[first], lengths[first]
+
+        offsets = np.zeros(n+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(src, minlength=n))
+        lengths = np.maximum(lengths, np.finfo(np.float64).tiny)
+        return csr_matrix((lengths, dst, offsets), shape=(n, n))
+
+    def dijkstra(self, source, target=None, mode=None):
+        """ shortest paths from the vertex source using a binary heap
+            stops as soon as target is reached
+            returns dicts of the distances (km) and the predecessors """
+        adj = self.adjacency(mode)
+        dist = {source: 0.0}
+        pred = {source: -1}
+        heap = [(0.0, source)]
+        while heap:
+            d, v = heapq.heappop(heap)
+            if d > dist[v]:
+                continue #outdated heap entry
+            if v == target:
+                break
+            for w, l in adj[v]:
+                nd = d + l
+                if w not in dist or nd < dist[w]:
+                    dist[w] = nd
+                    pred[w] = v
+                    heapq.heappush(heap, (nd, w))
+        return dist, pred
+
+    def oneToMany(self, source, targets, mode=None):
+        """ distances (km) from source to all targets (inf if unreachable)
+            the search stops as soon as all targets are settled """
+        adj = self.adjacency(mode)
+        result = np.empty(len(targets))
+        result.fill(np.inf)
+        wanted = {}
+        for i, t in enumerate(targets):
+            wanted.setdefault(t, []).append(i)
+        left = len(wanted)
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        while heap and left:
+            d, v = heapq.heappop(heap)
+            if d > dist[v]:
+                continue #outdated heap entry
+            if v in wanted:
+                result[wanted[v]] = d
+                left -= 1
+            for w, l in adj[v]:
+                nd = d + l
+                if w not in dist or nd < dist[w]:
+                    dist[w] = nd
+                    heapq.heappush(heap, (nd, w))
+        return result
+
+    def astar(self, source, target, mode=None):
+        """ shortest path search from source to target guided by the
+            haversine distance to the target (never more than the remaining
+            way length - so the result is still the shortest path)
+            returns dicts of the distances (km) and the predecessors """
+        adj = self.adjacency(mode)
+        if not hasattr(self, '_radians'):
+            self._radians = ((np.asarray(self.lat) * math.pi / 180).tolist(),
+                    (np.asarray(self.lon) * math.pi / 180).tolist())
+        lat, lon = self._radians
+        tlat = lat[target]
+        tlon = lon[target]
+        coslat = math.cos(tlat)
+        def h(v):
+            a = math.sin((lat[v]-tlat)/2)**2 + \
+                    math.sin((lon[v]-tlon)/2)**2 * math.cos(lat[v]) * coslat
+            return 2 * 6371 * math.asin(min(1.0, math.sqrt(a)))
+
+        dist = {source: 0.0}
+        pred = {source: -1}
+        heap = [(h(source), 0.0, source)]
+        while heap:
+            f, d, v = heapq.heappop(heap)
+            if d > dist[v]:
+                continue #outdated heap entry
+            if v == target:
+                break
+            for w, l in adj[v]:
+                nd = d + l
+                if w not in dist or nd < dist[w]:
+                    dist[w] = nd
+                    pred[w] = v
+                    heapq.heappush(heap, (nd + h(w), nd, w))
+        return dist, pred
+
+    def route(self, source, target, mode=None, algorithm='astar'):
+        """ returns the length (km) and the vertex list of the shortest path
+            between two vertexes - (None, []) if there is none """
+        if algorithm == 'dijkstra':
+            dist, pred = self.dijkstra(source, target, mode)
+        else:
+            dist, pred = self.astar(source, target, mode)
+        if target not in dist:
+            return None, []
+        path = [target]
+        while pred[path[-1]] != -1:
+            path.append(pred[path[-1]])
+        return dist[target], path[::-1]
+
+    def save(self, filename):
+        vprint( "CSR graph export to '"+filename+"'",1)
+        writeArrays(filename, self.MAGIC, self.VERSION, 0, self.COUNTS,
+                {'v':self.numVertices(), 'e':self.numEdges()}, self.ARRAYS, self)
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """ loads a saved graph, the arrays are memory mapped read only """
+        flags, arrays = readArrays(filename, cls.MAGIC, cls.VERSION, cls.COUNTS,
+                cls.ARRAYS, mmap)
+        return cls(**arrays)
+
+# SpatialIndex
+#
+# snaps coordinates to the network: KD-trees over the graph vertexes (the end
+# nodes of the highways) and over short pieces of all highway segments.
+# Coordinates are projected to a plane in km around the mean latitude which
+# is exact enough on the scale of a city. The trees need scipy, it is only
+# imported when a query is made.
+class SpatialIndex:
+    PIECE = 0.05        # km, maximum length of the indexed segment pieces
+    NEIGHBOURS = 8      # pieces checked per query before asking for more
+    # sliding midpoint trees - queries are several times faster on points
+    # lined up along streets than with the default median splits
+    TREE = {'balanced_tree':False, 'compact_nodes':False}
+
+    def __init__(self, ids, lat, lon, vclasses, ways=None, segways=None,
+            seglat=None, seglon=None, segclasses=None):
+        self.ids = np.asarray(ids)          # osm node id of each vertex
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.vclasses = vclasses            # bit 1<<class for each adjacent highway class
+        self.ways = ways or []              # way ids
+        self.segways = segways              # way (index into ways) of each segment
+        self.seglat = seglat                # (segments, 2) start and end coordinates
+        self.seglon = seglon
+        self.segclasses = segclasses
+        self.trees = {}
+        lat0 = float(self.lat.mean()) if len(self.lat) else 0.
+        self.ky = 6371 * math.pi / 180      # km per degree
+        self.kx = self.ky * math.cos(lat0 * math.pi / 180)
+
+    @classmethod
+    def fromOSM(cls, osm):
+        """ index of the vertexes and segments of all highways """
+        ways = [w for w in osm.ways.itervalues() if 'highway' in w.tags and len(w.nds) > 1]
+        counts = np.fromiter((len(w.nds) for w in ways), np.int64, len(ways))
+        total = int(counts.sum())
+        idx = osm.nodes.indices(itertools.chain.from_iterable(w.nds for w in ways), total)
+        lat = osm.nodes.lat[idx]
+        lon = osm.nodes.lon[idx]
+        classes = np.fromiter((highwayClass(w.tags) for w in ways), np.uint8, len(ways))
+        wayidx = np.repeat(np.arange(len(ways), dtype=np.int32), counts)
+
+        # segment i goes from node i to node i+1 of the same way
+        starts = np.cumsum(counts) - counts
+        ends = starts + counts - 1
+        inner = np.ones(total, dtype=bool)
+        inner[ends] = False
+        first = np.flatnonzero(inner)
+
+        ends = np.concatenate([starts, ends])
+        ids, inverse = np.unique(osm.nodes.ids[idx[ends]], return_inverse=True)
+        vlat = np.zeros(len(ids))
+        vlon = np.zeros(len(ids))
+        vlat[inverse] = lat[ends]
+        vlon[inverse] = lon[ends]
+        vclasses = np.zeros(len(ids), dtype=np.uint16)
+        np.bitwise_or.at(vclasses, inverse,
+                np.left_shift(1, np.tile(classes, 2)).astype(np.uint16))
+
+        return cls(ids, vlat, vlon, vclasses, [w.id for w in ways], wayidx[first],
+                np.column_stack([lat[first], lat[first+1]]),
+                np.column_stack([lon[first], lon[first+1]]), classes[wayidx[first]])
+
+    @classmethod
+    def fromGraph(cls, graph):
+        """ index of the vertexes of a CSRGraph (same order) - without
+            geometry there are no segments to snap to """
+        n = graph.numVertices()
+        highway = np.left_shift(1, np.asarray(graph.highway, dtype=np.uint16)).astype(np.uint16)
+        src = np.repeat(np.arange(n), np.diff(np.asarray(graph.offsets)))
+        vclasses = np.zeros(n, dtype=np.uint16)
+        np.bitwise_or.at(vclasses, src, highway)
+        np.bitwise_or.at(vclasses, np.asarray(graph.targets), highway)
+        return cls(graph.ids, graph.lat, graph.lon, vclasses)
+
+    def project(self, lat, lon):
+        """ returns the planar coordinates (km) in an extra last axis """
+        return np.stack([np.asarray(lon, dtype=np.float64) * self.kx,
+                np.asarray(lat, dtype=np.float64) * self.ky], axis=-1)
+
+    def classMask(self, classes):
+        mask = 0
+        for c in classes:
+            mask |= 1 << int(c)
+        return mask
+
+    def vertexTree(self, classes=None):
+        """ returns (KD-tree, vertexes in it), built once per class filter """
+        key = ('v', classes and tuple(sorted(classes)))
+        if key not in self.trees:
+            from scipy.spatial import cKDTree
+            if classes:
+                subset = np.flatnonzero(self.vclasses & self.classMask(classes))
+            else:
+                subset = np.arange(len(self.ids))
+            if len(subset) == 0:
+                raise ValueError("no vertexes of highway classes %s" % (classes,))
+            points = self.project(self.lat[subset], self.lon[subset])
+            self.trees[key] = (cKDTree(points, **self.TREE), subset)
+        return self.trees[key]
+
+    def pieceTree(self, classes=None):
+        """ returns (KD-tree of the piece midpoints, segment of each piece,
+            half of the longest piece) """
+        key = ('e', classes and tuple(sorted(classes)))
+        if key not in self.trees:
+            from scipy.spatial import cKDTree
+            if self.segways is None:
+                raise ValueError("index has no segments")
+            if classes:
+                segs = np.flatnonzero(np.in1d(self.segclasses, list(classes)))
+            else:
+                segs = np.arange(len(self.segways))
+            if len(segs) == 0:
+                raise ValueError("no segments of highway classes %s" % (classes,))
+            a = self.project(self.seglat[segs, 0], self.seglon[segs, 0])
+            b = self.project(self.seglat[segs, 1], self.seglon[segs, 1])
+            length = np.sqrt(((b - a)**2).sum(axis=1))
+            n = np.maximum(1, np.ceil(length / self.PIECE)).astype(np.int64)
+            piece = np.repeat(np.arange(len(segs)), n)
+            k = np.arange(len(piece)) - np.repeat(np.cumsum(n) - n, n)
+            t = ((k + 0.5) / n[piece])[:, None]
+            mid = a[piece] + t * (b[piece] - a[piece])
+            half = float((length / n).max()) / 2
+            self.trees[key] = (cKDTree(mid, **self.TREE), segs[piece], half)
+        return self.trees[key]
+
+    def nearestVertices(self, lat, lon, classes=None):
+        """ returns the vertexes (indexes into ids) next to the coordinates and
+            their distances in km - classes limits the vertexes to the ones
+            with adjacent highways of these HIGHWAY_CLASSES """
+        tree, subset = self.vertexTree(classes)
+        dist, i = tree.query(self.project(lat, lon))
+        return subset[i], dist
+
+    def segmentDistances(self, points, segs):
+        """ distances of points (n, 2) to the segments (n, k) and the position
+            (0..1) of the projected points on them """
+        a = self.project(self.seglat[segs, 0], self.seglon[segs, 0])
+        b = self.project(self.seglat[segs, 1], self.seglon[segs, 1])
+        d = b - a
+        dd = (d * d).sum(axis=-1)
+        t = ((points[:, None, :] - a) * d).sum(axis=-1) / np.where(dd > 0, dd, 1)
+        t = np.clip(t, 0, 1)
+        p = a + t[..., None] * d
+        return np.sqrt(((points[:, None, :] - p)**2).sum(axis=-1)), t
+
+    def nearestEdges(self, lat, lon, classes=None):
+        """ snaps the coordinates to the nearest point on a highway segment
+            returns (way ids, lat and lon of the projected points, distances
+            in km), classes filters the highways as in nearestVertices """
+        tree, pieces, half = self.pieceTree(classes)
+        points = self.project(lat, lon)
+        seg = np.zeros(len(points), dtype=np.int64)
+        t = np.zeros(len(points))
+        dist = np.zeros(len(points))
+        todo = np.arange(len(points))
+        k = self.NEIGHBOURS
+        while len(todo):
+            k = min(k, len(pieces))
+            near, i = tree.query(points[todo], k)
+            near = near.reshape(len(todo), k)
+            segs = pieces[i.reshape(len(todo), k)]
+            d, tc = self.segmentDistances(points[todo], segs)
+            best = np.argmin(d, axis=1)
+            rows = np.arange(len(todo))
+            seg[todo] = segs[rows, best]
+            t[todo] = tc[rows, best]
+            dist[todo] = d[rows, best]
+            if k == len(pieces):
+                break
+            # a closer segment could only have pieces further away than the
+            # checked ones if the k-th piece is not far enough - ask again
+            # for more pieces
+            todo = todo[near[:, -1] - half < dist[todo]]
+            k *= 4
+
+        plat = self.seglat[seg, 0] + t * (self.seglat[seg, 1] - self.seglat[seg, 0])
+        plon = self.seglon[seg, 0] + t * (self.seglon[seg, 1] - self.seglon[seg, 0])
+        return [self.ways[w] for w in self.segways[seg]], plat, plon, dist
+
+# distance matrix
+#
+# the rows of a many-to-many matrix are computed by a pool of processes which
+# all map the same saved CSR file read only
+matrixGraph = None
+
+def initMatrixWorker(filename):
+    global matrixGraph
+    matrixGraph = CSRGraph.load(filename)
+
+def matrixRows(task):
+    origins, destinations, mode = task
+    return [matrixGraph.oneToMany(o, destinations, mode) for o in origins]
+
+def distanceMatrix(graph, origins, destinations, mode=None, processes=None, filename=None):
+    """ returns the shortest path lengths (km) from all origins to all
+        destinations (vertex indexes) as dense numpy array, inf means
+        unreachable. filename is the saved CSR file of the graph, a temporary
+        one is written if there is none """
+    origins = list(origins)
+    destinations = list(destinations)
+    if processes == 1:
+        return np.array([graph.oneToMany(o, destinations, mode) for o in origins]).reshape(
+                len(origins), len(destinations))
+
+    tmpdir = None
+    if filename is None:
+        tmpdir = tempfile.mkdtemp(prefix="osm2graph")
+        filename = os.path.join(tmpdir, "matrix.graph")
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = None
+    rows = []
+    try:
+        if tmpdir is not None:
+            graph.save(filename)
+        pool = multiprocessing.Pool(processes, initMatrixWorker, (filename,))
+        # a few chunks per process to even out the load
+        size = max(1, len(origins) // (4 * processes))
+        tasks = [(origins[i:i+size], destinations, mode) for i in range(0, len(origins), size)]
+        for chunk in pool.imap(matrixRows, tasks):
+            rows.extend(chunk)
+    finally:
+        # the workers and the temporary graph go on errors and interrupts, too
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    return np.array(rows).reshape(len(origins), len(destinations))
+
+# ContractionHierarchy
+#
+# preprocessed CSRGraph for fast point to point queries: the vertexes are
+# contracted one after another (least important first) and shortcuts keep the
+# shortest paths between the remaining ones. The importance is recomputed for
+# the neighbours of every contracted vertex. A query is a bidirectional
+# Dijkstra which only goes upwards in the contraction order.
+# up holds the edges to higher ranked vertexes, down the edges coming from
+# higher ranked vertexes (stored at the lower one for the backward search).
+# middle is the contracted vertex of a shortcut or -1 for an original edge.
+class ContractionHierarchy:
+    MAGIC = "O2GCH\0\0\0"
+    VERSION = 1
+    MODES = [None, 'foot', 'bike']
+    ARRAYS = [('rank', '<i4', 'v'),
+            ('up_offsets', '<i8', 'o'), ('up_targets', '<i4', 'u'),
+            ('up_weights', '<f8', 'u'), ('up_middle', '<i4', 'u'),
+            ('down_offsets', '<i8', 'o'), ('down_targets', '<i4', 'd'),
+            ('down_weights', '<f8', 'd'), ('down_middle', '<i4', 'd')]
+    COUNTS = 'vud'
+    HOP_LIMIT = 10 # edges of a witness path
+
+    def __init__(self, rank, up_offsets, up_targets, up_weights, up_middle,
+            down_offsets, down_targets, down_weights, down_middle, mode=None):
+        self.rank = rank
+        self.up_offsets = up_offsets
+        self.up_targets = up_targets
+        self.up_weights = up_weights
+        self.up_middle = up_middle
+        self.down_offsets = down_offsets
+        self.down_targets = down_targets
+        self.down_weights = down_weights
+        self.down_middle = down_middle
+        self.mode = mode
+
+    @classmethod
+    def build(cls, graph, mode=None):
+        """ contracts all vertexes of the graph using only the edges usable
+            with mode """
+        n = graph.numVertices()
+        out = [dict() for v in xrange(n)]
+        inn = [dict() for v in xrange(n)]
+        for v, edges in enumerate(graph.adjacency(mode)):
+            for w, l in edges:
+                if w != v and (w not in out[v] or l < out[v][w]):
+                    out[v][w] = l
+                    inn[w][v] = l
+
+        middle = {}
+        hops = {} # original edges of a shortcut
+        deleted = [0]*n
+        level = [0]*n
+        # shortcuts needed to contract each vertex - kept up to date as they
+        # only change when a neighbour is contracted
+        candidates = [None]*n
+        current = [0]*n
+        def priority(v):
+            # edge difference (weighted twice), contracted neighbours,
+            # difference of the original edges represented by the added and
+            # removed edges and the depth in the hierarchy
+            candidates[v] = cls.shortcuts(v, out, inn)
+            added = sum(hops.get((u, v), 1) + hops.get((v, w), 1) for u, w, c in candidates[v])
+            removed = sum(hops.get((v, w), 1) for w in out[v]) + \
+                    sum(hops.get((u, v), 1) for u in inn[v])
+            return 2 * (len(candidates[v]) - len(out[v]) - len(inn[v])) + deleted[v] + \
+                    added - removed + level[v]
+
+        heap = []
+        for v in xrange(n):
+            current[v] = priority(v)
+            heap.append((current[v], v))
+        heapq.heapify(heap)
+        rank = np.zeros(n, dtype=np.int32)
+        contracted = [False]*n
+        up = [None]*n
+        down = [None]*n
+        r = 0
+        while heap:
+            p, v = heapq.heappop(heap)
+            if contracted[v] or p != current[v]:
+                continue # outdated heap entry
+
+            for u, w, c in candidates[v]:
+                if w not in out[u] or c < out[u][w]:
+                    out[u][w] = c
+                    inn[w][u] = c
+                    middle[(u, w)] = v
+                    hops[(u, w)] = hops.get((u, v), 1) + hops.get((v, w), 1)
+
+            up[v] = [(w, l, middle.get((v, w), -1)) for w, l in out[v].iteritems()]
+            down[v] = [(u, l, middle.get((u, v), -1)) for u, l in inn[v].iteritems()]
+            neighbours = set(out[v])
+            neighbours.update(inn[v])
+            for w in out[v]:
+                del inn[w][v]
+            for u in inn[v]:
+                del out[u][v]
+            out[v] = {}
+            inn[v] = {}
+            candidates[v] = None
+            contracted[v] = True
+            rank[v] = r
+            r += 1
+            for w in neighbours:
+                deleted[w] += 1
+                level[w] = max(level[w], level[v] + 1)
+                current[w] = priority(w)
+                heapq.heappush(heap, (current[w], w))
+            if r % 10000 == 0:
+                vprint( "contracted "+str(r)+" of "+str(n)+" vertexes",2)
+
+        arrays = {'rank': rank}
+        for name, edges in (('up', up), ('down', down)):
+            offsets = np.zeros(n+1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(e) for e in edges])
+            flat = list(itertools.chain.from_iterable(edges))
+            arrays[name+'_offsets'] = offsets
+            arrays[name+'_targets'] = np.array([e[0] for e in flat], dtype=np.int32)
+            arrays[name+'_weights'] = np.array([e[1] for e in flat], dtype=np.float64)
+            arrays[name+'_middle'] = np.array([e[2] for e in flat], dtype=np.int32)
+        return cls(mode=mode, **arrays)
+
+    @classmethod
+    def shortcuts(cls, v, out, inn):
+        """ returns the shortcuts (u, w, length) needed if v is contracted """
+        res = []
+        if not inn[v] or not out[v]:
+            return res
+        for u, lu in inn[v].iteritems():
+            targets = dict((w, lu+lw) for w, lw in out[v].iteritems() if w != u)
+            if not targets:
+                continue
+            for w in cls.witness(u, v, out, targets):
+                res.append((u, w, targets[w]))
+        return res
+
+    @classmethod
+    def witness(cls, u, v, out, targets):
+        """ Dijkstra from u avoiding v limited to paths of HOP_LIMIT edges -
+            returns the targets without a path as short as the one over v
+            (these need a shortcut) """
+        # equally long paths summed up in another order are witnesses too
+        pending = dict((w, c * (1 + 1e-9)) for w, c in targets.iteritems())
+        limit = max(pending.itervalues())
+        missing = []
+        dist = {u: 0.0}
+        heap = [(0.0, 0, u)]
+        while heap:
+            d, h, x = heapq.heappop(heap)
+            if d > limit:
+                break
+            if d > dist[x]:
+                continue
+            if x in pending:
+                del pending[x]
+                missing.append(x)
+                if not pending:
+                    return missing
+                limit = max(pending.itervalues())
+            if h == cls.HOP_LIMIT:
+                continue
+            h += 1
+            for w, l in out[x].iteritems():
+                nd = d + l
+                if nd <= limit and w != v and (w not in dist or nd < dist[w]):
+                    dist[w] = nd
+                    heapq.heappush(heap, (nd, h, w))
+                    if w in pending and nd <= pending[w]:
+                        # witness found, the search ends with the farthest one
+                        del pending[w]
+                        if not pending:
+                            return missing
+                        limit = max(pending.itervalues())
+        missing.extend(pending)
+        return missing
+
+    def numShortcuts(self):
+        return int(np.count_nonzero(np.asarray(self.up_middle) >= 0) +
+                np.count_nonzero(np.asarray(self.down_middle) >= 0))
+
+    def lists(self):
+        """ plain list adjacency of the up and down edges and a lookup of the
+            shortcut middles (built once) """
+        if not hasattr(self, '_lists'):
+            shortcuts = {}
+            lists = []
+            for name in ('up', 'down'):
+                offsets = getattr(self, name+'_offsets').tolist()
+                edges = zip(getattr(self, name+'_targets').tolist(),
+                        getattr(self, name+'_weights').tolist(),
+                        getattr(self, name+'_middle').tolist())
+                adj = [edges[offsets[v]:offsets[v+1]] for v in xrange(len(offsets)-1)]
+                lists.append(adj)
+                for v, vedges in enumerate(adj):
+                    for w, l, m in vedges:
+                        if m >= 0:
+                            # key is the edge in driving direction
+                            shortcuts[(v, w) if name == 'up' else (w, v)] = m
+            self._lists = (lists[0], lists[1], shortcuts)
+        return self._lists
+
+    def route(self, source, target):
+        """ returns the length (km) and the vertex list of the shortest path
+            between two vertexes - (None, []) if there is none """
+        up, down, shortcuts = self.lists()
+        dist = ({source: 0.0}, {target: 0.0})
+        pred = ({source: -1}, {target: -1})
+        heaps = ([(0.0, source)], [(0.0, target)])
+        # edges of the search direction and the ones used to stall a vertex
+        # (reached cheaper from a higher ranked vertex - stall on demand)
+        adj = ((up, down), (down, up))
+        best = float('inf')
+        meet = -1
+        side = 1
+        while (heaps[0] and heaps[0][0][0] < best) or (heaps[1] and heaps[1][0][0] < best):
+            # alternate the directions as long as both have work left
+            if heaps[1-side] and heaps[1-side][0][0] < best:
+                side = 1-side
+            d, v = heapq.heappop(heaps[side])
+            mydist = dist[side]
+            if d > mydist[v]:
+                continue
+            other = dist[1-side]
+            if v in other and d + other[v] < best:
+                best = d + other[v]
+                meet = v
+            edges, stall = adj[side]
+            stalled = False
+            for w, l, m in stall[v]:
+                if w in mydist and mydist[w] + l < d:
+                    stalled = True
+                    break
+            if stalled:
+                continue
+            for w, l, m in edges[v]:
+                nd = d + l
+                if w not in mydist or nd < mydist[w]:
+                    mydist[w] = nd
+                    pred[side][w] = v
+                    heapq.heappush(heaps[side], (nd, w))
+        if meet == -1:
+            return None, []
+
+        # both search trees joined and with all shortcuts unpacked
+        forward = [meet]
+        while pred[0][forward[-1]] != -1:
+            forward.append(pred[0][forward[-1]])
+        backward = [meet]
+        while pred[1][backward[-1]] != -1:
+            backward.append(pred[1][backward[-1]])
+        chain = forward[::-1] + backward[1:]
+
+        def unpack(u, w):
+            m = shortcuts.get((u, w), -1)
+            if m == -1:
+                return [w]
+            return unpack(u, m) + unpack(m, w)
+        path = [chain[0]]
+        for u, w in zip(chain[:-1], chain[1:]):
+            path.extend(unpack(u, w))
+        return best, path
+
+    def save(self, filename):
+        vprint( "contraction hierarchy export to '"+filename+"'",1)
+        writeArrays(filename, self.MAGIC, self.VERSION, self.MODES.index(self.mode),
+                self.COUNTS, {'v':len(self.rank), 'u':len(self.up_targets),
+                    'd':len(self.down_targets)}, self.ARRAYS, self)
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        flags, arrays = readArrays(filename, cls.MAGIC, cls.VERSION, cls.COUNTS,
+                cls.ARRAYS, mmap)
+        return cls(mode=cls.MODES[flags], **arrays)
+
+    def report(self, graph, seconds, queries=100):
+        """ prints preprocessing time and query speed-up against A* """
+        vprint( "contraction hierarchy: %d vertexes, %d edges, %d shortcuts, "
+                "preprocessing %.2f s" % (len(self.rank), graph.numEdges(),
+                    self.numShortcuts(), seconds),1)
+        n = graph.numVertices()
+        if n == 0:
+            return
+        rand = np.random.RandomState(1)
+        pairs = zip(rand.randint(0, n, queries), rand.randint(0, n, queries))
+        self.lists()
+        graph.adjacency(self.mode)
+        start = time.time()
+        for s, t in pairs:
+            graph.route(s, t, self.mode)
+        plain = (time.time() - start) / queries
+        start = time.time()
+        for s, t in pairs:
+            self.route(s, t)
+        ch = (time.time() - start) / queries
+        vprint( "query: A* %.3f ms, contraction hierarchy %.3f ms, speed-up %.1fx" %
+                (plain*1000, ch*1000, plain / max(ch, 1e-9)),1)
+
+# binary array files
+#
+# a header (magic, version, flags and element counts) followed by arrays
+# in a fixed order, little endian and 8 byte aligned - so they can be
+# memory mapped. Arrays are sized by one of the counts, 'o' is the vertex
+# count 'v' plus one (CSR offsets).
+def arrayLayout(arrays, counts, offset):
+    """ yields name, type, count and file offset of every array """
+    for name, dtype, per in arrays:
+        if per == 'o':
+            count = counts['v']+1
+        else:
+            count = counts[per]
+        yield name, np.dtype(dtype), count, offset
+        offset += count * np.dtype(dtype).itemsize
+        offset += -offset % 8 # keep all arrays 8 byte aligned
+
+def writeArrays(filename, magic, version, flags, countnames, counts, arrays, obj):
+    """ saves the arrays (attributes of obj) """
+    header = struct.Struct('<8sII' + 'q'*len(countnames))
+    fp = open(filename, "wb")
+    fp.write(header.pack(magic, version, flags, *[counts[c] for c in countnames]))
+    for name, dtype, count, offset in arrayLayout(arrays, counts, header.size):
+        fp.write("\0" * (offset - fp.tell()))
+        np.asarray(getattr(obj, name), dtype=dtype).tofile(fp)
+    fp.close()
+
+def readArrays(filename, magic, version, countnames, arrays, mmap=True):
+    """ returns the flags and a dict of the arrays of a saved file """
+    header = struct.Struct('<8sII' + 'q'*len(countnames))
+    fp = open(filename, "rb")
+    values = header.unpack(fp.read(header.size))
+    if values[0] != magic:
+        raise ValueError("'"+filename+"' has the wrong file type")
+    if values[1] != version:
+        raise ValueError("'"+filename+"' has the unsupported version "+str(values[1]))
+    counts = dict(zip(countnames, values[3:]))
+    result = {}
+    for name, dtype, count, offset in arrayLayout(arrays, counts, header.size):
+        if count == 0:
+            result[name] = np.zeros(0, dtype=dtype)
+        elif mmap:
+            result[name] = np.memmap(filename, dtype=dtype, mode='r',
+                    offset=offset, shape=(count,))
+        else:
+            fp.seek(offset)
+            result[name] = np.fromfile(fp, dtype=dtype, count=count)
+    fp.close()
+    return values[2], result
+
+# build cache
+#
+# the parsed, split graph (with PT edges) is pickled to a cache directory
+# keyed by the input content, the build options and the version of this
+# program - so different exports of the same input skip the parsing
+# the cache is only used if asked for (--cache) and the least recently used
+# files are removed when it grows over CACHE_LIMIT bytes
+CACHE_LIMIT = 2 << 30
+
+def cacheKey(filename, transport, streaming, parser="expat", keep=None):
+    h = hashlib.sha1()
+    fp = open(filename, 'rb')
+    for chunk in iter(lambda: fp.read(1<<20), ''):
+        h.update(chunk)
+    fp.close()
+    h.update("transport=%s streaming=%s parser=%s" % (transport, streaming, parser))
+    h.update("tags=%s" % (None if keep is None else sorted(keep)))
+    # changes of the program invalidate the cache as well
+    source = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+    h.update(open(source, 'rb').read())
+    return h.hexdigest()
+
+def defaultCacheDir():
+    base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'osm2graph')
+
+def evictCache(cachedir, limit=None):
+    """ removes the least recently used files (builds and tiles) until the
+        cache is not bigger than limit bytes (default CACHE_LIMIT) """
+    if limit is None:
+        limit = CACHE_LIMIT
+    files = []
+    for path, dirs, names in os.walk(cachedir):
+        for name in names:
+            if not name.endswith(".tmp"):
+                filename = os.path.join(path, name)
+                files.append((os.path.getmtime(filename), os.path.getsize(filename), filename))
+    total = sum(size for used, size, filename in files)
+    for used, size, filename in sorted(files):
+        if total <= limit:
+            break
+        vprint( "cache is full - removing '%s'",1, filename)
+        os.remove(filename)
+        total -= size
+
+def buildOSM(filename, transport, streaming=False, processes=None, cachedir=None,
+        parser="expat", keep=None, cachelimit=None):
+    """ returns the OSM object for a file, reusing a cached build if there
+        is one - cachedir None disables the cache, see evictCache for the
+        limit """
+    if cachedir is None:
+        return OSM(filename, transport, streaming, processes, parser, keep)
+
+    cachefile = os.path.join(cachedir,
+            cacheKey(filename, transport, streaming, parser, keep)+".pickle")
+    if os.path.exists(cachefile):
+        vprint( "using cached build '"+cachefile+"'",1)
+        try:
+            with profiler.stage("cache_load"):
+                osm = loadState(cachefile)
+            os.utime(cachefile, None) # recently used
+            return osm
+        except Exception, e:
+            vprint( "cache file is broken ("+str(e)+") - rebuilding",0)
+
+    osm = OSM(filename, transport, streaming, processes, parser, keep)
+
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    with profiler.stage("cache_save"):
+        saveState(osm, cachefile)
+    vprint( "build cached in '"+cachefile+"'",2)
+    evictCache(cachedir, cachelimit)
+    return osm
+
+# saved graphs (build cache and --save-state) are pickled OSM objects
+def loadState(filename):
+    vprint( "loading graph '"+filename+"'",2)
+    fp = open(filename, 'rb')
+    osm = pickle.load(fp)
+    fp.close()
+    return osm
+
+def saveState(osm, filename):
+    vprint( "saving graph to '"+filename+"'",2)
+    # write to a temp file first to never leave half written files
+    tmpfile = filename + ".%d.tmp" % os.getpid()
+    fp = open(tmpfile, 'wb')
+    pickle.dump(osm, fp, pickle.HIGHEST_PROTOCOL)
+    fp.close()
+    os.rename(tmpfile, filename)
+
+# returns the vertex of a "lat,lon" coordinate or an osm node id
+def parseLocation(graph, text):
+    if ',' in text:
+        lat, lon = [float(x) for x in text.split(",")]
+        return graph.nearestVertex(lat, lon)
+    return graph.vertexIndex(text)
+
+# reads a file with one location per line ('lat,lon' or osm node id)
+# the coordinates are snapped all at once with a SpatialIndex of the graph
+def readLocations(graph, filename):
+    fp = open(filename)
+    lines = [line.strip() for line in fp if line.strip()]
+    fp.close()
+    coords = [i for i, line in enumerate(lines) if ',' in line]
+    locations = [None if ',' in line else graph.vertexIndex(line) for line in lines]
+    if coords:
+        lat, lon = np.array([[float(x) for x in lines[i].split(",")] for i in coords]).T
+        vertexes, dist = SpatialIndex.fromGraph(graph).nearestVertices(lat, lon)
+        for i, v in zip(coords, vertexes):
+            locations[i] = int(v)
+    return locations
+
+# reads a file of 'lat,lon' lines and writes them snapped to the network as
+# csv: the nearest vertex (osm node id, distance) and if the index has
+# segments the nearest point on a highway (way id, lat, lon, distance)
+def snapLocations(index, infile, outfile, classes=None):
+    fp = open(infile)
+    lat, lon = np.array([[float(x) for x in line.split(",")]
+            for line in fp if line.strip()]).reshape(-1, 2).T
+    fp.close()
+    start = time.time()
+    vertexes, vdist = index.nearestVertices(lat, lon, classes)
+    edges = index.segways is not None
+    if edges:
+        ways, plat, plon, edist = index.nearestEdges(lat, lon, classes)
+    vprint( "snapped %d locations in %.2f s" % (len(lat), time.time() - start),1)
+
+    out = open(outfile, "w")
+    header = "lat,lon,node,node_dist"
+    if edges:
+        header += ",way,way_lat,way_lon,way_dist"
+    out.write(header + "\n")
+    for i in xrange(len(lat)):
+        line = "%r,%r,%d,%f" % (lat[i], lon[i], index.ids[vertexes[i]], vdist[i])
+        if edges:
+            line += ",%s,%r,%r,%f" % (ways[i], plat[i], plon[i], edist[i])
+        out.write(line + "\n")
+    out.close()
+
 # main
 #
 # method to read the command line arguments and run the program
@@ -804,16 +3880,91 @@ def main():
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-f','--filename','--file', help='the path to a local file')
     group.add_argument("-b", "--bbox", help="an area to download highways in the format 'left,bottom,right,top'")
+    parser.add_argument("--api", default=OVERPASS_API,
+            help="overpass interpreter to download from (default: %(default)s)")
+    parser.add_argument("--tile-size", type=float, default=0.05,
+            help="bigger bboxes are downloaded in tiles of this size in degrees (default: %(default)s)")
+    parser.add_argument("--download-workers", type=int, default=2,
+            help="number of tiles downloaded at the same time (default: %(default)s)")
+    parser.add_argument("--download-file", metavar="FILE",
+            help="keep the merged download of --bbox in FILE (default: a temporary file "
+                "which is removed after reading it)")
     parser.add_argument("-t", "--transport", choices=["all", "hw", "pt"], default="all",
             help="Experimental Option! Uses as well public transportation information")
+    parser.add_argument("-s", "--streaming", action="store_true",
+            help="read a local file twice to keep only the routable network in memory, "
+                "the nodes it shares with the other ways still split it")
+    parser.add_argument("-j", "--processes", type=int,
+            help="number of processes to decode .osm.pbf files, split the ways and build "
+                "the PT edges (default: number of cpus)")
+    parser.add_argument("--parser", choices=["expat", "sax"], default="expat",
+            help="xml parser, sax is the old slower one (default: %(default)s)")
+    parser.add_argument("--filter-tags", nargs='?', const="", metavar="KEYS",
+            help="let the expat parser keep only the network ways and the tags the "
+                "conversion needs ("+",".join(sorted(PARSE_TAGS))+") and the ones with "
+                "these extra comma separated keys - faster, but the nodes other ways "
+                "share with the network no longer split it and the exports lose "
+                "the other tags")
+    parser.add_argument("--cache", nargs='?', const=defaultCacheDir(), metavar="DIR",
+            help="keep the built graph and downloaded tiles in DIR (default: "
+                "~/.cache/osm2graph) to reuse them for the same input and options")
+    parser.add_argument("--cache-limit", type=int, default=CACHE_LIMIT >> 20, metavar="MB",
+            help="remove the least recently used cache files above this size "
+                "(default: %(default)s)")
+    parser.add_argument("--load-state", metavar="FILE",
+            help="continue with a graph saved by --save-state instead of reading osm data")
+    parser.add_argument("-u", "--update", metavar="OSC", action="append", default=[],
+            help="apply an osmChange file (.osc or .osc.gz) to the graph - can be given several times")
+    parser.add_argument("--save-state", metavar="FILE",
+            help="save the graph (after the updates) to FILE to update it later")
+    parser.add_argument("--simplify", action="store_true",
+            help="merge chains of ways with the same routing tags into single edges")
     parser.add_argument("-o", "--osm-file", nargs='?', const='export.osm',
-            help="export the routeable graph as osm-xml to given file")
+            help="export the routeable graph as osm-xml to given file (gzipped if it ends with .gz)")
             #type=argparse.FileType('w'),
+    parser.add_argument("-z", "--gzip", action="store_true",
+            help="gzip the osm-xml export")
     parser.add_argument("-m", "--matlab-file", nargs='?', const='export.m',
             help="export the routable graph as ugly Matlab file")
+    parser.add_argument("--columns", metavar="FILE",
+            help="stream the directed graph as edge and node columns: FILE.csv (as "
+                "FILE_edges.csv and FILE_nodes.csv), FILE.npz or else a directory of .npy files")
             #type=argparse.FileType('w'),
+    parser.add_argument("--sqlite", metavar="FILE",
+            help="export the vertexes, the edges with geometry and the PT routes to a "
+                "new SQLite database with spatial and adjacency indexes")
+    parser.add_argument("-c", "--csr-file", nargs='?', const='export.graph',
+            help="export the routable graph as binary CSR file (memory mappable)")
+    parser.add_argument("-G", "--load-graph",
+            help="use a saved CSR file (see -c) for routing instead of reading osm data")
+    parser.add_argument("-r", "--route", nargs=2, metavar=("FROM", "TO"),
+            help="print the shortest route between two points given as 'lat,lon' or osm node id")
+    parser.add_argument("--mode", choices=["foot", "bike"],
+            help="only use edges with access for this mode when routing")
+    parser.add_argument("--algorithm", choices=["astar", "dijkstra"], default="astar",
+            help="shortest path algorithm (default: %(default)s)")
+    parser.add_argument("--matrix", nargs=3, metavar=("ORIGINS", "DESTINATIONS", "OUTPUT"),
+            help="write the distance matrix between the locations of two files (one 'lat,lon' or node id per line) "+
+                "to OUTPUT (.npy or raw float64), processes as in -j")
+    parser.add_argument("--snap", nargs=2, metavar=("INPUT", "OUTPUT"),
+            help="snap the 'lat,lon' lines of INPUT to the nearest vertex and highway and write them as csv to OUTPUT")
+    parser.add_argument("--snap-classes",
+            help="only snap to highways of these comma separated classes (1:footway, 2:cycleway, "+
+                "3:big_street, 4:small_street)")
+    parser.add_argument("--ch", action="store_true",
+            help="build a contraction hierarchy for routing (saved next to the CSR file) and report its speed-up")
     parser.add_argument("-g", "--graph", help="show the routeable graph in a plot - only for smaller ones recommended",
                             dest="graph", action="store_true")
+    parser.add_argument("--render", metavar="FILE",
+            help="draw the highways at their coordinates to an image (.png, .svg or .pdf) "
+                "- fast and without a display")
+    parser.add_argument("--render-size", type=int, default=2000,
+            help="pixels of the longer side of the image (default: %(default)s)")
+    parser.add_argument("--profile", metavar="FILE",
+            help="write the time and memory (rss growth, rss after it, peak of the pool "
+                "workers) of each stage as json to FILE")
+    parser.add_argument("--profile-dump", metavar="FILE",
+            help="run under cProfile and save its statistics to FILE (see pstats)")
     parser.add_argument("-v", "--verbosity", type=int, choices=[0, 1, 2, 3],
                                 help="increase output verbosity")
     args = parser.parse_args()
@@ -826,28 +3977,164 @@ def main():
         parser.print_help()
         sys.exit(0)
 
+    if args.profile_dump:
+        import cProfile
+        prof = cProfile.Profile()
+        try:
+            prof.runcall(run, args)
+        finally:
+            prof.dump_stats(args.profile_dump)
+            vprint( "cProfile statistics saved to '"+args.profile_dump+"'",1)
+    else:
+        run(args)
+
+    profiler.printReport()
+    if args.profile:
+        profiler.save(args.profile, argv=sys.argv[1:])
+
+# run
+#
+# does what the command line arguments of main ask for
+def run(args):
     #get the input
     fn = ""
     if args.filename:
         fn = args.filename
 
+    cachedir = args.cache
+    cachelimit = args.cache_limit << 20
+
+    downloaded = None # temporary file of the download
     if args.bbox:
         [left,bottom,right,top] = [float(x) for x in args.bbox.split(",")]
-        fn = getNetwork(left,bottom,right,top,args.transport)
-    if fn==None:
-        Sys.exit("ERROR: no input given")
+        with profiler.stage("download"):
+            fn = getNetwork(left,bottom,right,top,args.transport,args.api,
+                    args.tile_size,args.download_workers,cachedir,args.download_file,
+                    cachelimit)
+        if args.download_file is None:
+            downloaded = fn
+    if not fn and not args.load_graph and not args.load_state:
+        sys.exit("ERROR: no input given")
 
-    fp = open( fn,'r' )
-    osm = OSM(fp,args.transport)
-    fp.close()
+    osm = None
+    if args.load_state:
+        with profiler.stage("state_load"):
+            osm = loadState(args.load_state)
+    elif fn:
+        keep = None
+        if args.filter_tags is not None:
+            # the keys the conversion needs are always kept
+            keep = PARSE_TAGS | frozenset(k for k in args.filter_tags.split(",") if k)
+        try:
+            osm = buildOSM(fn,args.transport,args.streaming,args.processes,cachedir,
+                    args.parser,keep,cachelimit)
+        finally:
+            if downloaded is not None:
+                os.remove(downloaded)
+    elif args.osm_file or args.matlab_file or args.columns or args.sqlite or args.csr_file \
+            or args.graph or args.render:
+        sys.exit("ERROR: exports need osm data as input")
+
+    if args.update and osm is None:
+        sys.exit("ERROR: updates need osm data as input")
+    for filename in args.update:
+        with profiler.stage("update"):
+            osm.update(filename)
+    if args.save_state:
+        with profiler.stage("state_save"):
+            saveState(osm, args.save_state)
+
+    if args.simplify and osm is not None:
+        with profiler.stage("simplify"):
+            osm.contractChains()
 
     if args.osm_file:
         vprint( "OSM-XML file export to '"+args.osm_file+"'",1)
-        osm.export(args.osm_file,args.transport)
+        with profiler.stage("export_osm"):
+            osm.export(args.osm_file,args.transport,args.gzip)
+
+    if args.columns:
+        with profiler.stage("export_columns"):
+            osm.exportColumns(args.columns)
+
+    if args.sqlite:
+        with profiler.stage("export_sqlite"):
+            osm.exportSQLite(args.sqlite)
 
     if args.matlab_file:
         vprint( "Export to Matlab file '"+args.matlab_file+"'",1)
-        osm.convert2mat(args.matlab_file)
+        with profiler.stage("export_matlab"):
+            osm.convert2mat(args.matlab_file)
+
+    graph = None
+    if args.load_graph:
+        with profiler.stage("csr_load"):
+            graph = CSRGraph.load(args.load_graph)
+    elif args.csr_file or args.route or args.matrix or args.ch:
+        with profiler.stage("csr"):
+            graph = osm.toCSR()
+
+    if args.csr_file:
+        with profiler.stage("export_csr"):
+            graph.save(args.csr_file)
+
+    # contraction hierarchies are kept next to the CSR file
+    ch = None
+    chfile = None
+    if args.csr_file or args.load_graph:
+        chfile = (args.csr_file or args.load_graph) + ".ch"
+    if args.ch:
+        with profiler.stage("contraction_hierarchy") as stage:
+            ch = ContractionHierarchy.build(graph, args.mode)
+        ch.report(graph, stage['seconds'])
+        if chfile:
+            ch.save(chfile)
+    elif args.load_graph and os.path.exists(chfile):
+        ch = ContractionHierarchy.load(chfile)
+        vprint( "using contraction hierarchy '"+chfile+"'",2)
+
+    if args.route:
+        source = parseLocation(graph, args.route[0])
+        target = parseLocation(graph, args.route[1])
+        with profiler.stage("route") as stage:
+            if ch is not None and ch.mode == args.mode:
+                length, path = ch.route(source, target)
+            else:
+                length, path = graph.route(source, target, args.mode, args.algorithm)
+        vprint( "route query took %.3f s",2, stage['seconds'])
+        if length is None:
+            print "no route found"
+        else:
+            print "route: %f km over %d vertexes" % (length, len(path))
+            print ",".join(str(graph.ids[v]) for v in path)
+
+    if args.matrix:
+        origins = readLocations(graph, args.matrix[0])
+        destinations = readLocations(graph, args.matrix[1])
+        vprint( "distance matrix of %d x %d locations",1, len(origins), len(destinations))
+        with profiler.stage("matrix") as stage:
+            matrix = distanceMatrix(graph, origins, destinations, args.mode,
+                    args.processes, args.load_graph or args.csr_file)
+        vprint( "distance matrix took %.2f s",1, stage['seconds'])
+        if args.matrix[2].endswith('.npy'):
+            np.save(args.matrix[2], matrix)
+        else:
+            matrix.tofile(args.matrix[2])
+
+    if args.snap:
+        classes = None
+        if args.snap_classes:
+            classes = [int(c) for c in args.snap_classes.split(",")]
+        with profiler.stage("snap"):
+            if osm is not None:
+                index = SpatialIndex.fromOSM(osm)
+            else:
+                index = SpatialIndex.fromGraph(graph)
+            snapLocations(index, args.snap[0], args.snap[1], classes)
+
+    if args.render:
+        with profiler.stage("render"):
+            osm.render(args.render, args.render_size)
 
     if args.graph:
         vprint( "Show as graph",1)
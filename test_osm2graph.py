@@ -0,0 +1,426 @@
+# regression tests of osm2graph, run them with
+#
+#     python -m pytest test_osm2graph.py
+#
+# the fixtures are in testdata: small.osm is a small grid with bus and tram
+# routes and a landuse area touching a footway, split.osm has the special
+# cases of splitting ways (crossings, rings, a way using a node twice, stop
+# positions, ways starting or ending at a crossing, a way with a single node),
+# chain.osm is a street made of ways running in both directions, small.osc
+# is an osmChange of small.osm and small-updated.osm the result of it,
+# small.osm.pbf is small.osm in the PBF format
+import csv
+import itertools
+import os
+import sqlite3
+import copy
+
+import numpy as np
+import pytest
+
+import benchmark
+import osm2graph
+
+osm2graph.verbose = 0
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+FIXTURES = ['small.osm', 'split.osm']
+TRANSPORTS = ['hw', 'pt', 'all']
+
+# the way splitting before splitRanges - kept as reference
+def sliceArray(ar, dividers):
+    """ slices the node list at every inner node used more than once """
+    for i in range(1,len(ar)-1):
+        if dividers[ar[i]]>1:
+            left = ar[:i+1]
+            right = ar[i:]
+            return [left]+sliceArray(right, dividers)
+    return [ar]
+
+def nodeHistogram(ways, nodes, transport):
+    """ counts the uses of each node, stop positions twice with pt """
+    histogram = dict.fromkeys((nid for way in ways.itervalues() for nid in way.nds), 0)
+    for way in ways.itervalues():
+        for nid in way.nds:
+            if transport != "hw" and (nodes.checkTag(nid,'public_transport','stop_position') or
+                    nodes.checkTag(nid,'railway','tram_stop')):
+                histogram[nid] += 2
+            else:
+                histogram[nid] += 1
+    return histogram
+
+def recursiveSplitWays(transport):
+    """ returns a replacement of OSM.splitWays which splits by sliceArray """
+    def splitWays(self, dividers, processes=None):
+        histogram = nodeHistogram(self.ways, self.nodes, transport)
+        new_ways = {}
+        vways = {}
+        for wid in self.ways.keys():
+            way = self.ways[wid]
+            vways[wid] = []
+            for k, nds in enumerate(sliceArray(way.nds, histogram)):
+                part = copy.copy(way)
+                part.id = "%s-%d" % (wid, k)
+                part.nds = nds
+                new_ways[part.id] = part
+                vways[wid].append(part.id)
+        self.ways = new_ways
+        self.vways = vways
+    return splitWays
+
+def fixture(name):
+    return os.path.join(TESTDATA, name)
+
+@pytest.mark.parametrize('name', FIXTURES)
+@pytest.mark.parametrize('transport', TRANSPORTS)
+def test_split_ranges_match_recursive_slicing(name, transport):
+    osm = osm2graph.OSM(fixture(name), transport, processes=1)
+    nodes, ways, relations = osm.readExpat(fixture(name), osm.keep)
+    osm.nodes = nodes
+    osm.ways = ways
+    dividers = osm.dividerNodes(transport, processes=1)
+    histogram = nodeHistogram(osm.ways, nodes, transport)
+    assert dividers == set(nid for nid, n in histogram.iteritems() if n > 1)
+    for way in osm.ways.itervalues():
+        parts = [part.nds for part in way.split(dividers)]
+        assert parts == sliceArray(way.nds, histogram), way.id
+        assert [part.id for part in way.split(dividers)] == \
+                ["%s-%d" % (way.id, k) for k in range(len(parts))]
+
+def test_split_cases():
+    osm = osm2graph.OSM(fixture('split.osm'), 'all', processes=1)
+    # crossing in the middle, the end of one way is the start of the next
+    assert [osm.ways[p].nds for p in osm.vways['10']] == [['1','2','3'], ['3','4'], ['4','5']]
+    assert [osm.ways[p].nds for p in osm.vways['11']] == [['6','3'], ['3','7']]
+    # a ring is split where another way touches it, not at its own ends
+    assert [osm.ways[p].nds for p in osm.vways['13']] == [['20','21','22'], ['22','23','20']]
+    assert [osm.ways[p].nds for p in osm.vways['15']] == [['30','31','32','30']]
+    # a way using a node twice is split there
+    assert [osm.ways[p].nds for p in osm.vways['17']] == \
+            [['50','51'], ['51','52','53','51'], ['51','54']]
+    # the tram stop 43 splits a way with public transport only
+    assert [osm.ways[p].nds for p in osm.vways['16']] == \
+            [['40','41'], ['41','42'], ['42','43'], ['43','44']]
+    hw = osm2graph.OSM(fixture('split.osm'), 'hw', processes=1)
+    assert [hw.ways[p].nds for p in hw.vways['16']] == [['40','41'], ['41','42'], ['42','43','44']]
+    # ways with a single node are dropped
+    assert '18' not in osm.vways
+
+@pytest.mark.parametrize('name', FIXTURES)
+@pytest.mark.parametrize('transport', TRANSPORTS)
+def test_exports_match_recursive_split(name, transport, tmpdir, monkeypatch):
+    def exports(prefix):
+        osm = osm2graph.OSM(fixture(name), transport, processes=1)
+        osm.export(str(tmpdir.join(prefix + '.osm')), transport)
+        osm.convert2mat(str(tmpdir.join(prefix + '.m')))
+        return [tmpdir.join(prefix + ext).read('rb') for ext in ('.osm', '.m')]
+
+    new = exports('new')
+    monkeypatch.setattr(osm2graph.OSM, 'splitWays', recursiveSplitWays(transport))
+    old = exports('old')
+    assert new[0] == old[0]
+    assert new[1] == old[1]
+
+def test_contract_chains_keeps_stored_ways():
+    osm = osm2graph.OSM(fixture('chain.osm'), 'hw', processes=1)
+    ways = dict(osm.ways)
+    nds = dict((wid, list(way.nds)) for wid, way in ways.iteritems())
+    osm.contractChains()
+    # ways running against the chain are merged as reversed copies
+    assert [way.nds for way in osm.ways.itervalues()] in \
+            ([['1','2','3','4','5']], [['5','4','3','2','1']])
+    for wid, way in ways.iteritems():
+        assert way.nds == nds[wid], wid
+
+@pytest.mark.parametrize('name', FIXTURES)
+@pytest.mark.parametrize('transport', TRANSPORTS)
+def test_expat_matches_sax(name, transport, tmpdir):
+    def exports(parser):
+        osm = osm2graph.OSM(fixture(name), transport, processes=1, parser=parser)
+        osm.export(str(tmpdir.join(parser + '.osm')), transport)
+        osm.convert2mat(str(tmpdir.join(parser + '.m')))
+        return [tmpdir.join(parser + ext).read('rb') for ext in ('.osm', '.m')]
+
+    assert exports('expat') == exports('sax')
+
+@pytest.mark.parametrize('parser', ['expat', 'sax'])
+@pytest.mark.parametrize('name', FIXTURES)
+@pytest.mark.parametrize('transport', TRANSPORTS)
+def test_expat_matches_sax_streaming(name, transport, parser):
+    # streaming keeps only the network of the transport, its ways are split
+    # as by sax, the dropped ways included
+    full = osm2graph.OSM(fixture(name), transport, processes=1, parser='sax')
+    osm = osm2graph.OSM(fixture(name), transport, streaming=True, processes=1, parser=parser)
+    for wid, parts in osm.vways.iteritems():
+        assert parts == full.vways[wid], wid
+    for wid, way in osm.ways.iteritems():
+        assert (way.nds, way.tags) == (full.ways[wid].nds, full.ways[wid].tags), wid
+    # the landuse way 502 splits the footway 100
+    if name == 'small.osm' and transport != 'pt':
+        assert [osm.ways[p].nds for p in osm.vways['100']][1:3] == \
+                [['1006','1040'], ['1040','1012']]
+
+def test_filter_tags():
+    # the landuse way 502 shares node 1040 with the footway 100
+    osm = osm2graph.OSM(fixture('small.osm'), 'hw', processes=1)
+    assert [osm.ways[p].nds for p in osm.vways['100']][1:3] == \
+            [['1006','1040'], ['1040','1012']]
+    assert osm.ways['502-0'].tags['name'] == 'Green'
+    # without the landuse way 100 is not split there
+    filtered = osm2graph.OSM(fixture('small.osm'), 'hw', processes=1,
+            keep=osm2graph.PARSE_TAGS)
+    assert [filtered.ways[p].nds for p in filtered.vways['100']][1] == \
+            ['1006','1040','1012']
+    assert '502' not in filtered.vways
+
+def test_filter_tags_adds_keys(tmpdir, monkeypatch):
+    # the given keys are kept in addition to the ones the conversion needs
+    def convert(*options):
+        out = str(tmpdir.join('out.m'))
+        monkeypatch.setattr('sys.argv', ['osm2graph.py', '-f', fixture('small.osm'),
+                '-t', 'all', '-m', out, '-v', '0'] + list(options))
+        osm2graph.main()
+        return open(out).read()
+
+    filtered = convert('--filter-tags')
+    assert 'Row 0' in filtered
+    assert convert('--filter-tags', 'name,surface') == filtered
+
+@pytest.mark.parametrize('streaming', [False, True])
+@pytest.mark.parametrize('transport', TRANSPORTS)
+def test_update_matches_fresh_build(transport, streaming):
+    # small.osc moves node 1014, makes 1015 a stop of route 7001, deletes
+    # the footway 101 and the landuse way 502 and adds the footway 600 and
+    # the building 601 (which splits way 4 with streaming, too),
+    # small-updated.osm is small.osm with these changes
+    osm = osm2graph.OSM(fixture('small.osm'), transport, streaming, processes=1)
+    osm.update(fixture('small.osc'))
+    fresh = osm2graph.OSM(fixture('small-updated.osm'), transport, streaming, processes=1)
+    assert osm.vways == fresh.vways
+    assert sorted(osm.ways) == sorted(fresh.ways)
+    for wid, way in fresh.ways.iteritems():
+        assert (osm.ways[wid].nds, osm.ways[wid].tags) == (way.nds, way.tags), wid
+        assert osm.ways[wid].length == pytest.approx(way.length), wid
+    if not streaming:
+        assert list(osm.nodes.ids) == list(fresh.nodes.ids)
+        assert osm.nodes.tags == fresh.nodes.tags
+
+@pytest.mark.parametrize('processes', [1, 2])
+@pytest.mark.parametrize('streaming', [False, True])
+@pytest.mark.parametrize('transport', TRANSPORTS)
+def test_pbf_matches_xml(transport, streaming, processes):
+    # small.osm.pbf is small.osm with dense nodes in two blocks with
+    # negative lat/lon offsets, the first one in descending id order
+    xml = osm2graph.OSM(fixture('small.osm'), transport, streaming, processes=1)
+    pbf = osm2graph.OSM(fixture('small.osm.pbf'), transport, streaming, processes=processes)
+    assert list(pbf.nodes.ids) == list(xml.nodes.ids)
+    assert list(pbf.nodes.lat) == list(xml.nodes.lat)
+    assert list(pbf.nodes.lon) == list(xml.nodes.lon)
+    assert pbf.nodes.tags == xml.nodes.tags
+    assert pbf.vways == xml.vways
+    assert sorted(pbf.ways) == sorted(xml.ways)
+    for wid, way in xml.ways.iteritems():
+        assert (pbf.ways[wid].nds, pbf.ways[wid].tags) == (way.nds, way.tags), wid
+
+@pytest.fixture(scope='module')
+def grid(tmpdir_factory):
+    # the routing graph of a generated grid with 10% oneways, a fifth of the
+    # edges is closed for pedestrians and another fifth for bicycles
+    filename = str(tmpdir_factory.mktemp('grid').join('grid.osm'))
+    benchmark.generateGrid(filename, 400)
+    graph = osm2graph.OSM(filename, 'hw', processes=1).toCSR()
+    rand = np.random.RandomState(1)
+    graph.foot[:] = rand.rand(graph.numEdges()) > 0.2
+    graph.bike[:] = rand.rand(graph.numEdges()) > 0.2
+    return graph
+
+def pathLength(graph, path, mode):
+    """ sums up the shortest usable edge between each pair of path vertexes """
+    usable = {'foot': graph.foot, 'bike': graph.bike}.get(mode, np.ones(graph.numEdges()))
+    length = 0.0
+    for v, w in zip(path[:-1], path[1:]):
+        edges = [e for e in range(graph.offsets[v], graph.offsets[v+1])
+                if graph.targets[e] == w and usable[e]]
+        assert edges, (v, w)
+        length += min(graph.lengths[e] for e in edges)
+    return length
+
+@pytest.mark.parametrize('mode', osm2graph.ContractionHierarchy.MODES)
+def test_astar_and_ch_match_dijkstra(grid, mode):
+    ch = osm2graph.ContractionHierarchy.build(grid, mode)
+    rand = np.random.RandomState(2)
+    n = grid.numVertices()
+    reached = 0
+    for s, t in zip(rand.randint(0, n, 60), rand.randint(0, n, 60)):
+        length, path = grid.route(s, t, mode, algorithm='dijkstra')
+        for result in (grid.route(s, t, mode), ch.route(s, t)):
+            if length is None:
+                assert result == (None, [])
+                continue
+            assert result[0] == pytest.approx(length), (s, t)
+            assert result[1] == path, (s, t)
+            assert pathLength(grid, result[1], mode) == pytest.approx(length)
+        reached += length is not None
+    assert reached > 40
+
+@pytest.mark.parametrize('mode', [None, 'foot'])
+def test_distance_matrix(grid, mode, tmpdir, monkeypatch):
+    # some destinations can not be reached on foot
+    rand = np.random.RandomState(3)
+    n = grid.numVertices()
+    origins = rand.randint(0, n, 25)
+    destinations = rand.randint(0, n, 30)
+    single = osm2graph.distanceMatrix(grid, origins, destinations, mode, processes=1)
+    assert single.shape == (25, 30)
+    for i, o in enumerate(origins):
+        dist, pred = grid.dijkstra(o, mode=mode)
+        assert list(single[i]) == pytest.approx([dist.get(d, np.inf) for d in destinations])
+    # the pool workers load a temporary CSR file which is removed afterwards
+    monkeypatch.setattr('tempfile.tempdir', str(tmpdir))
+    assert np.array_equal(osm2graph.distanceMatrix(grid, origins, destinations, mode,
+            processes=2), single)
+    assert tmpdir.listdir() == []
+
+@pytest.mark.parametrize('neighbours,piece', [(8, 0.05), (1, 1.0)])
+@pytest.mark.parametrize('classes', [None, [5, 6]])
+def test_spatial_index_matches_brute_force(classes, neighbours, piece, monkeypatch):
+    # [5, 6] are the bus and tram edges - with whole segments as pieces and
+    # one piece per query most points need more pieces
+    monkeypatch.setattr(osm2graph.SpatialIndex, 'NEIGHBOURS', neighbours)
+    monkeypatch.setattr(osm2graph.SpatialIndex, 'PIECE', piece)
+    osm = osm2graph.OSM(fixture('small.osm'), 'all', processes=1)
+    index = osm2graph.SpatialIndex.fromOSM(osm)
+    ways = [w for w in osm.ways.itervalues() if 'highway' in w.tags and
+            (classes is None or osm2graph.highwayClass(w.tags) in classes)]
+    def point(nid):
+        i = osm.nodes.indices([nid], 1)[0]
+        return index.project(osm.nodes.lat[i], osm.nodes.lon[i])
+    def segmentDistance(p, a, b):
+        d = b - a
+        t = min(1, max(0, np.dot(p - a, d) / max(np.dot(d, d), 1e-300)))
+        return np.linalg.norm(p - a - t * d)
+    vertexes = set(nid for w in ways for nid in (w.nds[0], w.nds[-1]))
+
+    rand = np.random.RandomState(4)
+    lat = rand.uniform(index.seglat.min() - 0.001, index.seglat.max() + 0.001, 50)
+    lon = rand.uniform(index.seglon.min() - 0.001, index.seglon.max() + 0.001, 50)
+    nearest, vdist = index.nearestVertices(lat, lon, classes)
+    wids, plat, plon, edist = index.nearestEdges(lat, lon, classes)
+    for k in range(len(lat)):
+        p = index.project(lat[k], lon[k])
+        distances = dict((nid, np.linalg.norm(p - point(nid))) for nid in vertexes)
+        assert vdist[k] == pytest.approx(min(distances.values()))
+        assert distances[str(index.ids[nearest[k]])] == pytest.approx(vdist[k])
+        best = dict((w.id, min(segmentDistance(p, point(a), point(b))
+                for a, b in zip(w.nds[:-1], w.nds[1:]))) for w in ways)
+        assert edist[k] == pytest.approx(min(best.values()))
+        assert best[wids[k]] == pytest.approx(edist[k])
+        assert np.linalg.norm(p - index.project(plat[k], plon[k])) == pytest.approx(edist[k])
+
+@pytest.mark.parametrize('ext', ['', '.npz', '.csv'])
+@pytest.mark.parametrize('chunk', [4, osm2graph.EXPORT_CHUNK])
+def test_export_columns_matches_csr(ext, chunk, tmpdir, monkeypatch):
+    # chunks of 4 ways number the vertexes over many chunks
+    monkeypatch.setattr(osm2graph, 'EXPORT_CHUNK', chunk)
+    osm = osm2graph.OSM(fixture('small.osm'), 'all', processes=1)
+    osm.exportColumns(str(tmpdir.join('graph' + ext)))
+    if ext == '.csv':
+        tables = {}
+        for table in ('nodes', 'edges'):
+            rows = list(csv.DictReader(tmpdir.join('graph_' + table + '.csv').open('rb')))
+            tables[table] = dict((c, np.array([r[c] for r in rows]).astype(dtype))
+                    for c, dtype in getattr(osm2graph, table[:-1].upper() + '_COLUMNS')
+                    if c != 'name')
+    else:
+        files = np.load(str(tmpdir.join('graph.npz'))) if ext else dict((f.purebasename,
+                np.load(str(f))) for f in tmpdir.join('graph').listdir())
+        tables = dict((table, dict((c, files['%s_%s' % (table, c)])
+                for c, dtype in getattr(osm2graph, table[:-1].upper() + '_COLUMNS')))
+                for table in ('nodes', 'edges'))
+    nodes, edges = tables['nodes'], tables['edges']
+
+    graph = osm.toCSR()
+    assert sorted(nodes['id']) == list(graph.ids)
+    order = np.argsort(nodes['id'])
+    assert list(nodes['lat'][order]) == list(graph.lat)
+    assert list(nodes['lon'][order]) == list(graph.lon)
+    src = np.repeat(np.arange(graph.numVertices()), np.diff(graph.offsets))
+    expected = zip(graph.ids[src], graph.ids[graph.targets], graph.lengths,
+            graph.highway, graph.foot, graph.bike)
+    exported = zip(nodes['id'][edges['source']], nodes['id'][edges['target']],
+            edges['length'], edges['highway'], edges['foot'], edges['bike'])
+    assert sorted(exported) == sorted(expected)
+
+@pytest.mark.parametrize('chunk', [4, osm2graph.EXPORT_CHUNK])
+@pytest.mark.parametrize('transport', TRANSPORTS)
+def test_export_sqlite_counts(transport, chunk, tmpdir, monkeypatch):
+    monkeypatch.setattr(osm2graph, 'EXPORT_CHUNK', chunk)
+    osm = osm2graph.OSM(fixture('small.osm'), transport, processes=1)
+    filename = str(tmpdir.join('graph.sqlite'))
+    osm.exportSQLite(filename)
+    db = sqlite3.connect(filename)
+    def count(table):
+        return db.execute("SELECT count(*) FROM " + table).fetchone()[0]
+
+    ways = [w for w in osm.ways.itervalues() if 'highway' in w.tags]
+    assert count('nodes') == len(set(nid for w in ways for nid in (w.nds[0], w.nds[-1])))
+    assert count('edges') == len(ways)
+    assert count('arcs') == osm.toCSR().numEdges()
+    # the bus route 7001 and the tram route 7002 with 4 and 3 members and
+    # one PT edge each
+    pt = transport != 'hw'
+    assert count('routes') == 2 * pt
+    assert count('route_members') == 7 * pt
+    assert db.execute("SELECT route, way FROM route_edges JOIN edges ON edge = id "
+            "ORDER BY route").fetchall() == \
+            [(7001, 'special-7001-0'), (7002, 'special-7002-0')] * pt
+    db.close()
+
+@pytest.mark.parametrize('source,distance', [('small.osm', 0.1), ('small.osm', 0.26),
+        ('grid', 0.1), ('grid', 0.01)])
+def test_add_transfers_matches_brute_force(source, distance, tmpdir, monkeypatch):
+    # the generated grid has stop areas of a stop and a platform 14 m beside
+    # it (connected with 10 m, too), in small.osm only the platform 8000 is
+    # close to the stop 1013 - with 260 m the stops 1013 and 1024 of two
+    # routes are connected, too
+    monkeypatch.setattr(osm2graph, 'TRANSFER_DISTANCE', distance)
+    if source == 'grid':
+        filename = str(tmpdir.join('grid.osm'))
+        benchmark.generateGrid(filename, 400)
+    else:
+        filename = fixture(source)
+    osm = osm2graph.OSM(filename, 'pt', processes=1)
+    points, areas = osm.transferPoints()
+    x, y = osm.nodes.project(points)
+    xy = dict(zip(points, zip(x, y)))
+    def length(a, b):
+        return np.hypot(xy[a][0] - xy[b][0], xy[a][1] - xy[b][1])
+    streets = set(nid for w in osm.ways.itervalues() if 'highway' in w.tags and
+            w.tags['highway'] not in ('bus', 'tram') and not osm2graph.isTransfer(w.tags)
+            for nid in (w.nds[0], w.nds[-1]))
+    x, y = osm.nodes.project(sorted(streets))
+    xy.update(zip(sorted(streets), zip(x, y)))
+
+    expected = set()
+    for area in areas:
+        expected.update(itertools.combinations(area, 2))
+    for a, b in itertools.combinations(points, 2):
+        if length(a, b) <= distance:
+            expected.add((a, b))
+    for a in set(points) - streets:
+        near = min((length(a, s), int(s)) for s in streets)
+        if near[0] <= distance:
+            expected.add((a, str(near[1])))
+    expected = sorted(set('transfer-%d-%d' % tuple(sorted((int(a), int(b))))
+            for a, b in expected))
+    assert osm.transferEdges == expected
+    if source == 'grid':
+        assert len(expected) > 10
+    elif distance == 0.1:
+        assert expected == ['transfer-1013-8000']
+    else:
+        assert 'transfer-1013-1024' in expected
+    for wid in expected:
+        assert osm.ways[wid].nds == wid.split('-')[1:]
+        assert osm.ways[wid].tags == osm2graph.TRANSFER_TAGS
+    assert osm2graph.OSM(filename, 'hw', processes=1).transferEdges == []